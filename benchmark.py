@@ -0,0 +1,160 @@
+import json
+import time
+import random
+import argparse
+import tempfile
+import platform
+import tracemalloc
+import numpy as np
+import pygame
+from pathlib import Path
+
+start = time.perf_counter()
+import game
+import challenges
+IMPORT_MS = (time.perf_counter() - start) * 1000
+
+DEFAULT_SIZES = ["800x600", "1600x1200", "3200x2400"]
+
+def parse_size(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+def summarize(values):
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"mean": round(float(np.mean(values)), 4), "p50": round(float(p50), 4),
+            "p95": round(float(p95), 4), "p99": round(float(p99), 4), "max": round(float(np.max(values)), 4)}
+
+def run_frames(seed, map_size, frames, dirty_rects):
+    # Same seed, same map, same key presses: every run plays exactly the same game
+    random.seed(seed)
+    game_state = game.Game(seed, map_size, game.ScriptedInput(seed))
+    game_state.state = game.PLAYING
+    renderer = game.DirtyRectRenderer() if dirty_rects else None
+
+    start = time.perf_counter()
+    for _ in range(frames):
+        game.profiler.begin_frame()
+        with game.profiler.section("events"):
+            game_state.handle_events()
+        with game.profiler.section("update"):
+            game_state.update()
+        with game.profiler.section("draw"):
+            if renderer:
+                renderer.render(game_state)
+            else:
+                game_state.draw()
+        game.profiler.end_frame()
+    return time.perf_counter() - start, game_state
+
+def benchmark(seed, map_size, frames, dirty_rects):
+    # Map generation on its own, without the disk cache
+    start = time.perf_counter()
+    game.Map(*map_size, 20, seed, use_cache=False)
+    generation_ms = (time.perf_counter() - start) * 1000
+
+    # Timed pass, every phase of every frame goes into the profiler trace
+    game.profiler.reset()
+    game.profiler.enabled = True
+    game.profiler.tracing = True
+    elapsed, game_state = run_frames(seed, map_size, frames, dirty_rects)
+    phases = {}
+    for _, timings in game.profiler.trace:
+        for name, ms in timings.items():
+            phases.setdefault(name, []).append(ms)
+    game.profiler.enabled = False
+
+    # tracemalloc slows everything down, so peak memory gets a pass of its own
+    tracemalloc.start()
+    run_frames(seed, map_size, frames, dirty_rects)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "map_size": f"{map_size[0]}x{map_size[1]}",
+        "tiles": game_state.map.num_tiles_x * game_state.map.num_tiles_y,
+        "seed": seed,
+        "frames": frames,
+        "dirty_rects": dirty_rects,
+        "map_generation_ms": round(generation_ms, 3),
+        "fps": round(frames / elapsed, 2),
+        "phases_ms": {name: summarize(values) for name, values in sorted(phases.items())},
+        "peak_memory_kb": round(peak / 1024, 1),
+        "final_state": game_state.state,
+    }
+
+def benchmark_challenges(seed, count, rank=3):
+    # Bulk generation of every challenge type, then handing them out from a warm pool
+    start = time.perf_counter()
+    generated = challenges.generate_challenges(count, rank, seed=seed)
+    generate_s = time.perf_counter() - start
+
+    pool = challenges.ChallengePool(list(challenges.CHALLENGE_TYPES), size=count, seed=seed)
+    pool.warm(rank)
+    while rank in pool.requested:
+        time.sleep(0.01)
+    pool.prepare(count)
+    start = time.perf_counter()
+    for _ in range(count):
+        pool.take(rank)
+    take_s = time.perf_counter() - start
+
+    return {"count": len(generated), "generated_per_sec": round(len(generated) / generate_s),
+            "take_us": round(take_s / count * 1e6, 3)}
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Headless benchmark for Treasure Hunter Adventure")
+    parser.add_argument("--frames", type=int, default=300, help="frames to simulate per run")
+    parser.add_argument("--seed", type=game.map_seed, default=1234, help="seed for the map and the scripted input")
+    parser.add_argument("--sizes", nargs="+", default=DEFAULT_SIZES, metavar="WxH",
+                        help="map sizes in pixels to benchmark")
+    parser.add_argument("--dirty-rects", action="store_true", help="render through the dirty rectangle renderer")
+    parser.add_argument("--challenges", type=int, default=100000, help="challenges to generate in bulk")
+    parser.add_argument("--output", default="benchmark.json", help="where to write the JSON report")
+    return parser.parse_args()
+
+def cold_start(seed):
+    # Importing the modules, then from there to the first MENU frame on screen:
+    # init() on its own and init() with map generation and drawing together
+    start = time.perf_counter()
+    game.init(headless=True)
+    init_ms = (time.perf_counter() - start) * 1000
+    game.Game(seed).draw()  # A new game always opens on the menu
+    return {"import_ms": round(IMPORT_MS, 3), "init_ms": round(init_ms, 3),
+            "first_menu_frame_ms": round((time.perf_counter() - start) * 1000, 3)}
+
+def main():
+    args = parse_args()
+    # Games made here cache their maps in a folder of their own, so the cold start
+    # never finds maps an earlier run left behind and nothing is written to the
+    # current folder
+    with tempfile.TemporaryDirectory() as cache_dir:
+        game.MAP_FILE.cache_dir = Path(cache_dir)
+        startup = cold_start(args.seed)
+        results = []
+        for size in args.sizes:
+            result = benchmark(args.seed, parse_size(size), args.frames, args.dirty_rects)
+            print(f"{result['map_size']:>10}  {result['fps']:8.1f} fps  "
+                  f"frame p95 {result['phases_ms']['total']['p95']:6.2f} ms  "
+                  f"peak {result['peak_memory_kb']:9.1f} KiB")
+            results.append(result)
+
+    challenge_results = benchmark_challenges(args.seed, args.challenges)
+    print(f"challenges  {challenge_results['generated_per_sec']:8d} generated/s  "
+          f"take {challenge_results['take_us']:.2f} us")
+
+    report = {
+        "python": platform.python_version(),
+        "pygame": pygame.version.ver,
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cold_start": startup,
+        "runs": results,
+        "challenges": challenge_results,
+    }
+    with open(args.output, "w") as report_file:
+        json.dump(report, report_file, indent=2)
+    print(f"Wrote {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+import abc
+import queue
+import random
+import threading
+from collections import deque, namedtuple
+
+# Challenge types, the same ids game.py and newgame use
+COLLECTING = 0
+SPENDING = 1
+TREASURES = 2
+SHARING = 3
+MAPPING = 4
+CODES = 5
+SECRETS = 6
+FRACTIONS = 7
+TIME = 8
+MONEY = 9
+GEOMETRY = 10
+MEASUREMENT = 11
+
+# One ready to show challenge, lines is the text already wrapped for the screen
+Challenge = namedtuple("Challenge", ["kind", "rank", "text", "answer", "lines"])
+
+# Registered challenge generators by type id
+CHALLENGE_TYPES = {}
+
+def register(kind):
+    # Class decorator adding a challenge type to the registry
+    def add(cls):
+        cls.kind = kind
+        CHALLENGE_TYPES[kind] = cls()
+        return cls
+    return add
+
+class ChallengeType(abc.ABC):
+    # Makes challenges of one kind. Every type implements generate(), which
+    # returns (text, answer) for a rank, answers are always whole numbers
+    # written out as strings
+    kind = None
+    max_text_length = 200
+
+    @abc.abstractmethod
+    def generate(self, rng, rank):
+        pass
+
+    def generate_many(self, rng, rank, count):
+        return [self.generate(rng, rank) for _ in range(count)]
+
+    def validate(self, text, answer):
+        return bool(text) and len(text) <= self.max_text_length and answer.isdigit()
+
+@register(COLLECTING)
+class Collecting(ChallengeType):
+    def generate(self, rng, rank):
+        a = rng.randint(1, 10 * rank)
+        b = rng.randint(1, 10 * rank)
+        return (f"The treasure chest needs a special code! Count {a} glowing stones and {b} magical pebbles together to find the magic total.",
+                str(a + b))
+
+@register(SPENDING)
+class Spending(ChallengeType):
+    def generate(self, rng, rank):
+        a = rng.randint(10 * rank, 20 * rank)
+        b = rng.randint(1, a)
+        return (f"Oh no! The treasure is locked! If you had {a} gold coins and spent {b} coins on supplies, how many coins remain in your pouch?",
+                str(a - b))
+
+@register(TREASURES)
+class Treasures(ChallengeType):
+    def generate(self, rng, rank):
+        a = rng.randint(1, 5 + rank)
+        b = rng.randint(1, 10)
+        return (f"You found {a} treasure chests, each with {b} gems. How many gems have you discovered in total?",
+                str(a * b))
+
+@register(SHARING)
+class Sharing(ChallengeType):
+    def generate(self, rng, rank):
+        b = rng.randint(1, 5 + rank)
+        a = b * rng.randint(1, 10)
+        return (f"You need to share {a} gold coins equally among {b} crew members. How many coins does each crew member receive?",
+                str(a // b))
+
+@register(MAPPING)
+class Mapping(ChallengeType):
+    def generate(self, rng, rank):
+        a = rng.randint(30, 100)
+        return (f"Map reading: About how many paces to the nearest ten is {a} paces to the treasure?",
+                str(round(a / 10) * 10))
+
+@register(CODES)
+class Codes(ChallengeType):
+    def generate(self, rng, rank):
+        start = rng.randint(1, 5)
+        step = rng.randint(2, 5)
+        sequence = [start + step*i for i in range(4)]
+        return (f"Decode the secret sequence: {sequence[0]}, {sequence[1]}, {sequence[2]}, {sequence[3]}, ?",
+                str(sequence[3] + step))
+
+@register(SECRETS)
+class Secrets(ChallengeType):
+    # The whole pool of questions is fixed, so they are only written once
+    questions = [
+        ("How many edges does a triangular amulet have?", "3"),
+        ("How many edges does a square treasure map have?", "4"),
+        ("How many edges does a pentagonal coin have?", "5"),
+        ("How many edges does a hexagonal gem have?", "6")
+    ]
+
+    def generate(self, rng, rank):
+        return rng.choice(self.questions)
+
+@register(FRACTIONS)
+class Fractions(ChallengeType):
+    def generate(self, rng, rank):
+        denominator = rng.randint(2, 4 + rank)
+        numerator = rng.randint(1, denominator - 1)
+        whole = denominator * rng.randint(1, 5 + rank)
+        return (f"The captain gives you {numerator}/{denominator} of a chest holding {whole} pearls. How many pearls do you get?",
+                str(whole * numerator // denominator))
+
+@register(TIME)
+class Time(ChallengeType):
+    def generate(self, rng, rank):
+        hours = rng.randint(1, 2 + rank)
+        minutes = rng.randrange(0, 60, 5)
+        hour_word = "hour" if hours == 1 else "hours"
+        return (f"The tide comes back in {hours} {hour_word} and {minutes} minutes. How many minutes is that altogether?",
+                str(hours * 60 + minutes))
+
+@register(MONEY)
+class Money(ChallengeType):
+    def generate(self, rng, rank):
+        compass = rng.randint(1, 10 * rank)
+        lantern = rng.randint(1, 10 * rank)
+        paid = compass + lantern + rng.randint(0, 10 * rank)
+        return (f"A compass costs {compass} coins and a lantern costs {lantern} coins. You pay with {paid} coins. How many coins do you get back?",
+                str(paid - compass - lantern))
+
+@register(GEOMETRY)
+class Geometry(ChallengeType):
+    def generate(self, rng, rank):
+        width = rng.randint(2, 5 + rank)
+        height = rng.randint(2, 5 + rank)
+        if rng.random() < 0.5:
+            return (f"A treasure map is a rectangle {width} paces wide and {height} paces tall. How many paces is it all the way around?",
+                    str(2 * (width + height)))
+        return (f"The secret garden is a rectangle {width} paces wide and {height} paces long. How many square paces does it cover?",
+                str(width * height))
+
+@register(MEASUREMENT)
+class Measurement(ChallengeType):
+    def generate(self, rng, rank):
+        meters = rng.randint(1, 5 * rank)
+        if rng.random() < 0.5:
+            return (f"Your rope is {meters} meters long. How many centimeters long is it?", str(meters * 100))
+        return (f"The cave is {meters * 1000} meters away. How many kilometers is that?", str(meters))
+
+def generate_challenges(count, rank, kinds=None, seed=None):
+    # Bulk generation without layout, for many players at once or benchmarks.
+    # Every kind gets an equal share of count
+    rng = random.Random(seed)
+    kinds = list(CHALLENGE_TYPES) if kinds is None else list(kinds)
+    challenges = []
+    for i, kind in enumerate(kinds):
+        challenge_type = CHALLENGE_TYPES[kind]
+        share = count // len(kinds) + (i < count % len(kinds))
+        challenges.extend(Challenge(kind, rank, text, answer, None)
+                          for text, answer in challenge_type.generate_many(rng, rank, share))
+    return challenges
+
+class ChallengePool:
+    # Ready made challenges for each rank. A background thread keeps every rank
+    # that was asked for topped up. layout(text) gives the wrapped lines, it only
+    # runs on the thread that draws, because the fonts it measures with can't be
+    # used from two threads at once. That thread calls prepare() when it has
+    # time to spare, so take() is a deque pop of a challenge already laid out
+    def __init__(self, kinds, layout=None, size=32, seed=None):
+        self.challenge_types = [CHALLENGE_TYPES[kind] for kind in kinds]
+        self.layout = layout or (lambda text: (text,))
+        self.size = size
+        self.rng = random.Random(seed)  # Only used by the worker thread
+        self.fallback_rng = random.Random(self.rng.getrandbits(64))
+        self.pools = {}  # rank -> deque of challenges, not laid out yet
+        self.ready = {}  # rank -> deque of laid out challenges, only touched by the drawing thread
+        self.requests = queue.Queue()
+        self.requested = set()
+        self.worker = threading.Thread(target=self.fill_forever, name="challenges", daemon=True)
+        self.worker.start()
+
+    def make(self, rng, rank):
+        # One challenge that passed its type's validation, not laid out yet
+        while True:
+            challenge_type = rng.choice(self.challenge_types)
+            text, answer = challenge_type.generate(rng, rank)
+            if challenge_type.validate(text, answer):
+                return Challenge(challenge_type.kind, rank, text, answer, None)
+                
+    def lay_out(self, challenge):
+        return challenge._replace(lines=self.layout(challenge.text))
+
+    def fill_forever(self):
+        while True:
+            rank = self.requests.get()
+            pool = self.pools.setdefault(rank, deque())
+            while len(pool) + len(self.ready.get(rank, ())) < self.size:
+                pool.append(self.make(self.rng, rank))
+            self.requested.discard(rank)
+
+    def prepare(self, limit=2):
+        # Lay out up to limit generated challenges ahead of take()
+        for rank, pool in list(self.pools.items()):
+            ready = self.ready.setdefault(rank, deque())
+            while limit > 0 and pool:
+                ready.append(self.lay_out(pool.popleft()))
+                limit -= 1
+
+    def warm(self, *ranks):
+        # Start filling the pools for ranks that will be needed soon
+        for rank in ranks:
+            if rank not in self.requested:
+                self.requested.add(rank)
+                self.requests.put(rank)
+
+    def take(self, rank):
+        # Next challenge for rank. One that prepare() didn't get to yet is laid
+        # out here, and one is made on the spot only if the pool ran dry
+        ready = self.ready.get(rank)
+        pool = self.pools.get(rank)
+        if ready:
+            challenge = ready.popleft()
+        elif pool:
+            challenge = self.lay_out(pool.popleft())
+        else:
+            challenge = self.lay_out(self.make(self.fallback_rng, rank))
+        if len(ready or ()) + len(pool or ()) < self.size // 2:
+            self.warm(rank)
+        return challenge
@@ -0,0 +1,366 @@
+import contextlib
+import csv
+import functools
+import json
+import random
+import struct
+import time
+import zlib
+from collections import OrderedDict, deque
+from pathlib import Path
+import pygame
+import numpy as np
+
+# Code game.py and newgame share. Nothing here opens a window, whatever draws
+# uses the display surface that init() in each game opened
+
+# Terrain chunks are about half of the 800x600 screen each, so the camera never
+# needs more than 9 of them
+CHUNK_WIDTH, CHUNK_HEIGHT = 400, 300
+
+# Rendered text is cached by (font, text, color, antialias), least recently used first out
+TEXT_CACHE_SIZE = 256
+text_cache = OrderedDict()
+
+def render_text(font, text, color, antialias=True):
+    key = (font, text, tuple(color), antialias)
+    surface = text_cache.get(key)
+    if surface is None:
+        surface = font.render(text, antialias, color)
+        text_cache[key] = surface
+        if len(text_cache) > TEXT_CACHE_SIZE:
+            text_cache.popitem(last=False)
+    else:
+        text_cache.move_to_end(key)
+    return surface
+
+@functools.lru_cache(maxsize=128)
+def wrap_text(font, text, max_width):
+    # Split text into lines narrower than max_width, measuring word by word
+    lines = []
+    current_line = ""
+
+    for word in text.split():
+        test_line = current_line + word + " "
+        test_width = font.size(test_line)[0]
+
+        if test_width < max_width:
+            current_line = test_line
+        else:
+            lines.append(current_line)
+            current_line = word + " "
+
+    lines.append(current_line)
+    return tuple(lines)
+
+# Saved maps: a fixed header followed by a zlib compressed payload, laid out by
+# the game that made the map
+MAP_HEADER = struct.Struct("<4sBQIIHB")  # magic, version, seed, width, height, tile_size, difficulty
+MAP_CACHE_SIZE = 32  # Maps kept in each cache folder before the oldest ones are removed
+
+class MapFile:
+    # One game's saved maps. The two games make different maps, so each has its
+    # own magic and cache folder. Generated maps are cached on disk, keyed by
+    # everything that goes into generating them
+    def __init__(self, magic, generator, version):
+        self.magic = magic
+        self.generator = generator
+        self.version = version
+        self.cache_dir = Path('map_cache') / generator
+
+    def header(self, game_map):
+        return (game_map.seed, game_map.width, game_map.height, game_map.tile_size, game_map.difficulty)
+
+    def cache_path(self, game_map):
+        seed, width, height, tile_size, difficulty = self.header(game_map)
+        return self.cache_dir / f"{self.generator}{self.version}_{seed}_{width}x{height}_{tile_size}_d{difficulty}.map"
+
+    def prune_cache(self):
+        cached_maps = sorted(self.cache_dir.glob("*.map"), key=lambda path: path.stat().st_mtime, reverse=True)
+        for path in cached_maps[MAP_CACHE_SIZE:]:
+            path.unlink(missing_ok=True)
+
+    def save(self, path, game_map, payload):
+        # Write to a temporary file first so a crash never leaves half a map behind
+        path = Path(path)
+        try:
+            header = MAP_HEADER.pack(self.magic, self.version, *self.header(game_map))
+            path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path = path.with_suffix(".tmp")
+            temp_path.write_bytes(header + zlib.compress(payload))
+            temp_path.replace(path)
+        except (OSError, struct.error):
+            print(f"Unable to save map: {path}")
+
+    def load(self, path, game_map):
+        # Payload of the saved game_map, None if the file is missing or doesn't match
+        try:
+            data = Path(path).read_bytes()
+            magic, version, *header = MAP_HEADER.unpack_from(data)
+            if (magic, version) != (self.magic, self.version) or tuple(header) != self.header(game_map):
+                return None
+            return zlib.decompress(data[MAP_HEADER.size:])
+        except (OSError, struct.error, zlib.error):
+            return None
+
+class TileView:
+    # Thin view of one cell of a map's grid, kept so code that walks map.tiles
+    # still works. Each game subclasses it with its own tile names
+    __slots__ = ("game_map", "index")
+    names = ()  # Tile type name by tile id
+
+    def __init__(self, game_map, index):
+        self.game_map = game_map
+        self.index = index
+
+    @property
+    def type(self):
+        return self.names[self.game_map.grid.flat[self.index]]
+
+    @type.setter
+    def type(self, tile_type):
+        self.game_map.set_tile(self.index % self.game_map.num_tiles_x, self.index // self.game_map.num_tiles_x, tile_type)
+
+    @property
+    def x(self):
+        return self.index % self.game_map.num_tiles_x * self.game_map.tile_size
+
+    @property
+    def y(self):
+        return self.index // self.game_map.num_tiles_x * self.game_map.tile_size
+
+    @property
+    def size(self):
+        return self.game_map.tile_size
+
+class TileList:
+    # Read-only sequence of tile_class views over a map grid
+    def __init__(self, game_map, tile_class):
+        self.game_map = game_map
+        self.tile_class = tile_class
+
+    def __len__(self):
+        return self.game_map.grid.size
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("tile index out of range")
+        return self.tile_class(self.game_map, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.tile_class(self.game_map, index)
+
+def tile_centers(game_map, tiles, count):
+    # Pixel centres for count spawns on the flat tile indices in tiles. With
+    # fewer tiles than spawns the rest share tiles, with none at all they all
+    # go in the middle of the map
+    if not len(tiles):
+        return [(game_map.width // 2, game_map.height // 2)] * count
+
+    if len(tiles) < count:
+        extra = [tiles[random.randrange(len(tiles))] for _ in range(count - len(tiles))]
+        tiles = np.concatenate((tiles, extra))
+
+    tile_y, tile_x = np.divmod(tiles, game_map.num_tiles_x)
+    centers_x = tile_x * game_map.tile_size + game_map.tile_size // 2
+    centers_y = tile_y * game_map.tile_size + game_map.tile_size // 2
+    return list(zip(centers_x.tolist(), centers_y.tolist()))
+
+class TerrainCache:
+    # Static terrain baked into chunk surfaces, one colour per tile id from
+    # colors. Only chunks overlapping the camera are drawn and only changed
+    # chunks are baked again. Subclasses can take the tiles from somewhere other
+    # than game_map.grid by overriding tiles()
+    empty_color = (0, 0, 0)  # Fills chunks tiles() has nothing for
+
+    def __init__(self, game_map, colors, chunk_tiles=None, max_chunks=None):
+        self.game_map = game_map
+        self.colors = colors
+        tile_size = game_map.tile_size
+
+        # Every chunk holds a whole number of tiles
+        if chunk_tiles is None:
+            chunk_tiles = (max(1, CHUNK_WIDTH // tile_size), max(1, CHUNK_HEIGHT // tile_size))
+        self.chunk_tiles_x, self.chunk_tiles_y = chunk_tiles
+        self.chunk_width = self.chunk_tiles_x * tile_size
+        self.chunk_height = self.chunk_tiles_y * tile_size
+
+        # (chunk_x, chunk_y) -> baked surface, least recently drawn first. Past
+        # max_chunks the oldest is dropped
+        self.chunks = OrderedDict()
+        self.max_chunks = max_chunks
+        self.dirty = set()
+
+    def invalidate_tile(self, tile_x, tile_y):
+        self.dirty.add((tile_x // self.chunk_tiles_x, tile_y // self.chunk_tiles_y))
+
+    def invalidate_chunk(self, chunk_x, chunk_y):
+        # Drop the surface of a chunk that will not be drawn for a while
+        self.chunks.pop((chunk_x, chunk_y), None)
+        self.dirty.discard((chunk_x, chunk_y))
+
+    def invalidate_all(self):
+        self.chunks.clear()
+        self.dirty.clear()
+
+    def tiles(self, chunk_x, chunk_y):
+        # Tile ids of a chunk, None if there are none to draw yet
+        start_x = chunk_x * self.chunk_tiles_x
+        start_y = chunk_y * self.chunk_tiles_y
+        return self.game_map.grid[start_y:start_y + self.chunk_tiles_y, start_x:start_x + self.chunk_tiles_x]
+
+    def bake_chunk(self, chunk_x, chunk_y):
+        tiles = self.tiles(chunk_x, chunk_y)
+        if tiles is None:
+            return None
+        tile_size = self.game_map.tile_size
+
+        surface = self.chunks.get((chunk_x, chunk_y))
+        if surface is None:
+            surface = pygame.Surface((self.chunk_width, self.chunk_height)).convert()
+            self.chunks[(chunk_x, chunk_y)] = surface
+            if self.max_chunks is not None and len(self.chunks) > self.max_chunks:
+                self.chunks.popitem(last=False)
+
+        # Look up the colours of the whole chunk at once and scale every tile up to tile_size pixels
+        pixels = np.zeros((self.chunk_width, self.chunk_height, 3), dtype=np.uint8)
+        colors = self.colors[tiles.T].repeat(tile_size, axis=0).repeat(tile_size, axis=1)
+        pixels[:colors.shape[0], :colors.shape[1]] = colors
+        pygame.surfarray.blit_array(surface, pixels)
+
+        self.dirty.discard((chunk_x, chunk_y))
+        return surface
+
+    def draw(self, camera_x, camera_y):
+        # Only the chunks overlapping the camera view are touched
+        screen = pygame.display.get_surface()
+        view_width, view_height = screen.get_size()
+        first_x = max(0, int(camera_x) // self.chunk_width)
+        first_y = max(0, int(camera_y) // self.chunk_height)
+        last_x = min((self.game_map.width - 1) // self.chunk_width, int(camera_x + view_width) // self.chunk_width)
+        last_y = min((self.game_map.height - 1) // self.chunk_height, int(camera_y + view_height) // self.chunk_height)
+
+        for chunk_y in range(first_y, last_y + 1):
+            for chunk_x in range(first_x, last_x + 1):
+                key = (chunk_x, chunk_y)
+                position = (chunk_x * self.chunk_width - camera_x, chunk_y * self.chunk_height - camera_y)
+                surface = self.chunks.get(key)
+                if surface is None or key in self.dirty:
+                    surface = self.bake_chunk(chunk_x, chunk_y)
+                else:
+                    self.chunks.move_to_end(key)
+                if surface is None:
+                    screen.fill(self.empty_color, (position, (self.chunk_width, self.chunk_height)))
+                else:
+                    screen.blit(surface, position)
+
+class FrameProfiler:
+    # Opt-in timer for the phases of every frame. Keeps a rolling window of timings
+    # for the on-screen overlay (F3) and can record each frame for a trace file
+    WINDOW = 300  # Frames the percentiles are taken over
+
+    def __init__(self):
+        self.enabled = False
+        self.show_overlay = False
+        self.tracing = False
+        self.frame = 0
+        self.frame_start = 0
+        self.current = {}  # phase -> milliseconds spent in this frame
+        self.history = {}  # phase -> recent frame timings
+        self.trace = []
+        self.overlay = None
+        self.overlay_font = None
+        self.null_section = contextlib.nullcontext()
+
+    def reset(self):
+        # Forget everything recorded so far, e.g. between benchmark runs
+        self.frame = 0
+        self.current = {}
+        self.history = {}
+        self.trace = []
+        self.overlay = None
+
+    def begin_frame(self):
+        if self.enabled:
+            self.current = {}
+            self.frame_start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.current[name] = self.current.get(name, 0) + (time.perf_counter() - start) * 1000
+
+    def profile(self, name):
+        # Decorator form of section() for methods that are timed as a whole
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.section(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def section(self, name):
+        # Time a block of code: with profiler.section("map"): ...
+        if not self.enabled:
+            return self.null_section
+        return self.timed(name)
+
+    def end_frame(self):
+        if not self.enabled:
+            return
+        self.current["total"] = (time.perf_counter() - self.frame_start) * 1000
+        for name, ms in self.current.items():
+            self.history.setdefault(name, deque(maxlen=self.WINDOW)).append(ms)
+        if self.tracing:
+            self.trace.append((self.frame, self.current))
+        self.frame += 1
+
+        # Refresh the overlay twice a second
+        if self.frame % 30 == 0:
+            self.overlay = None
+
+    def percentiles(self, name, percents=(50, 95, 99)):
+        return np.percentile(self.history[name], percents)
+
+    def draw_overlay(self):
+        # Returns the screen area it covered, or None when hidden
+        if not (self.enabled and self.show_overlay and self.history):
+            return None
+
+        if self.overlay is None:
+            if self.overlay_font is None:
+                self.overlay_font = pygame.font.SysFont('monospace', 14)
+            lines = [f"{'ms':<12}{'p50':>7}{'p95':>7}{'p99':>7}"]
+            for name in sorted(self.history, key=lambda name: name != "total"):
+                p50, p95, p99 = self.percentiles(name)
+                lines.append(f"{name:<12}{p50:7.2f}{p95:7.2f}{p99:7.2f}")
+
+            line_height = self.overlay_font.get_linesize()
+            self.overlay = pygame.Surface((250, line_height * len(lines) + 10), pygame.SRCALPHA)
+            self.overlay.fill((0, 0, 0, 180))
+            for i, line in enumerate(lines):
+                self.overlay.blit(self.overlay_font.render(line, True, (255, 255, 255)), (5, 5 + i * line_height))
+
+        screen = pygame.display.get_surface()
+        return screen.blit(self.overlay, (10, screen.get_height() - self.overlay.get_height() - 10))
+
+    def save_trace(self, path):
+        # One row per frame with the milliseconds spent in every phase, as CSV or JSON
+        path = Path(path)
+        phases = sorted({name for _, timings in self.trace for name in timings})
+        if path.suffix == ".json":
+            with open(path, "w") as trace_file:
+                json.dump([{"frame": frame, **timings} for frame, timings in self.trace], trace_file)
+        else:
+            with open(path, "w", newline="") as trace_file:
+                writer = csv.writer(trace_file)
+                writer.writerow(["frame"] + phases)
+                for frame, timings in self.trace:
+                    writer.writerow([frame] + [round(timings.get(name, 0), 4) for name in phases])
@@ -1,16 +1,30 @@
 import pygame
 import random
+import functools
+from collections import OrderedDict
 import sys
 import math
 import os
+import struct
+import zlib
+import argparse
+import time
+import queue
+import threading
+from pathlib import Path
+import numpy as np
+from engine import FrameProfiler, MapFile, TerrainCache, TileList, TileView, render_text, tile_centers, wrap_text
+from challenges import ChallengePool, COLLECTING, SPENDING, TREASURES, SHARING, MAPPING, CODES, SECRETS
 
-# Initialize pygame
-pygame.init()
+IMPORT_TIME = time.perf_counter()  # For measuring the time to the first frame
 
 # Screen dimensions
 WIDTH, HEIGHT = 800, 600
-screen = pygame.display.set_mode((WIDTH, HEIGHT))
-pygame.display.set_caption("Treasure Hunter Adventure")
+
+# The window and fonts only exist after init(), so importing this module from
+# tools and tests opens nothing
+screen = None
+HEADLESS = False
 
 # Colors
 BLUE = (100, 149, 237)
@@ -25,152 +39,571 @@ GRASS = (124, 252, 0)
 ROCK = (128, 128, 128)
 DARK_GREEN = (0, 100, 0)
 
+# Simulation runs at a fixed rate, all speeds and timers count ticks
+TICK_RATE = 60
+TICK = 1 / TICK_RATE
+MAX_FRAME_TIME = 0.25  # Longest stall the simulation catches up on, in seconds
+
 # Game states
 MENU = 0
 PLAYING = 1
 CHALLENGE = 2
 GAME_OVER = 3
 
-# Challenge types
-COLLECTING = 0
-SPENDING = 1
-TREASURES = 2
-SHARING = 3
-MAPPING = 4
-CODES = 5
-SECRETS = 6
+# Challenge types this game hands out, generated by the challenges module
+GAME_CHALLENGES = [COLLECTING, SPENDING, TREASURES, SHARING, MAPPING, CODES, SECRETS]
+CHALLENGE_TEXT_WIDTH = WIDTH*2//3 - 40  # Scroll width minus its margins
+
+# Challenge scroll, where the answer and timer change
+SCROLL_RECT = pygame.Rect(WIDTH//2 - WIDTH//3, HEIGHT//2 - HEIGHT//3, WIDTH*2//3, HEIGHT*2//3)
+
+# Tile types, stored as small integers in the map grid
+WATER_TILE = 0
+SAND_TILE = 1
+GRASS_TILE = 2
+FOREST_TILE = 3
+ROCK_TILE = 4
+
+TILE_NAMES = ["water", "sand", "grass", "forest", "rock"]
+TILE_IDS = {name: tile_id for tile_id, name in enumerate(TILE_NAMES)}
+
+# Tile colours by tile id, shared by the terrain cache and the minimap
+TILE_COLORS = np.array([WATER, SAND, GRASS, DARK_GREEN, ROCK], dtype=np.uint8)
+
+# Explorers can't walk on these
+BLOCKING_TILES = (WATER_TILE, ROCK_TILE)
+
+# Minimap fog of war: unexplored color and how far around the explorer is uncovered
+FOG = (40, 40, 50)
+FOG_REVEAL_RADIUS = 300
+
+# Saved maps hold the island list and tile grid. The two games make different
+# maps, so each has its own magic and cache folder
+MAP_FILE = MapFile(b"THMI", "islands", 1)
+
+# Input recordings: a fixed header, then a zlib stream with one record per frame.
+# A record is a little endian u16 with the held arrow keys in bits 0-3, the ticks
+# the frame ran in bits 4-7, the number of key presses in bits 8-14 and bit 15
+# set when the record continues the frame before it, followed by one byte per
+# key press, an index into REPLAY_PRESSES
+REPLAY_FILE_MAGIC = b"THRP"
+REPLAY_FILE_VERSION = 2
+# magic, version, seed, random seed, width, height, fog of war, infinite, starting state
+REPLAY_HEADER = struct.Struct("<4sBQQIIBBB")
+REPLAY_FRAME = struct.Struct("<H")
+REPLAY_MAX_TICKS = 15  # Most ticks one record holds, longer frames are split over several records
+REPLAY_MAX_PRESSES = 127
+REPLAY_CONTINUED = 1 << 15
+REPLAY_FLUSH_FRAMES = 600  # A crash loses at most this many frames of a recording
+REPLAY_HELD_KEYS = (pygame.K_LEFT, pygame.K_RIGHT, pygame.K_UP, pygame.K_DOWN)
+REPLAY_PRESSES = [(pygame.K_SPACE, " "), (pygame.K_r, "r"), (pygame.K_RETURN, "\r"), (pygame.K_BACKSPACE, "\b"),
+                  (pygame.K_F3, "")] + [(pygame.K_0 + digit, str(digit)) for digit in range(10)]
+# Digits go by the character typed, the digit keys with shift held type something else
+REPLAY_KEY_CODES = {key: code for code, (key, text) in enumerate(REPLAY_PRESSES) if not text.isdigit()}
+REPLAY_DIGIT_CODES = {text: code for code, (_, text) in enumerate(REPLAY_PRESSES) if text.isdigit()}
+
+# Infinite worlds are generated in square chunks of tiles around the explorer.
+# World coordinates never go negative, the explorer starts in the middle
+WORLD_CHUNK_TILES = 16
+WORLD_CHUNKS = 1 << 16  # Chunks along each side of the world
+WORLD_STREAM_RADIUS = 3  # Chunks kept loaded around the explorer's chunk in every direction
+WORLD_RESIDENT_CHUNKS = 128  # Chunks in memory before the least recently used are evicted
+WORLD_BAKED_CHUNKS = 16  # Chunk surfaces kept for drawing
+WORLD_KEPT_CHUNKS = 1024  # Evicted edited chunks kept in memory, oldest edits are lost past this
+# Most chunks have an island and islands are big enough to run into their
+# neighbours, so the explorer can walk a long way
+WORLD_ISLAND_CHANCE = 0.85  # Chance of an island centred in any one chunk
+
+# Fonts, loaded by init()
+font_large = None
+font_medium = None
+font_small = None
+
+def init(headless=False):
+    # Start pygame, open the window and load the fonts. Headless runs (CI,
+    # benchmarks) draw into SDL's dummy video driver instead of a window.
+    # Calling it again does nothing
+    global screen, HEADLESS, font_large, font_medium, font_small
+    if screen is not None:
+        return screen
+        
+    HEADLESS = headless or os.environ.get("SDL_VIDEODRIVER") == "dummy"
+    if HEADLESS:
+        os.environ["SDL_VIDEODRIVER"] = "dummy"
+        os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+        
+    pygame.init()
+    screen = pygame.display.set_mode((WIDTH, HEIGHT))
+    pygame.display.set_caption("Treasure Hunter Adventure")
+    
+    font_large = pygame.font.SysFont('comicsansms', 48)
+    font_medium = pygame.font.SysFont('comicsansms', 32)
+    font_small = pygame.font.SysFont('comicsansms', 24)
+    
+    for entity_class in (Explorer, Treasure, Key):
+        sprite(entity_class)
+        
+    # The first ranks' challenges get made while the player is still on the menu
+    get_challenge_pool().warm(1, 2)
+    return screen
+
+challenge_pool = None  # Created on first use, needs the fonts for its layouts
+
+def get_challenge_pool():
+    global challenge_pool
+    if challenge_pool is None:
+        challenge_pool = ChallengePool(GAME_CHALLENGES, lambda text: wrap_text(font_small, text, CHALLENGE_TEXT_WIDTH))
+    return challenge_pool
+
+# Entity sprites are drawn once and after that only blitted. Each entity class
+# renders its own look and the anchor, the point that goes on its position
+sprite_atlas = {}  # entity class -> (surface, anchor x, anchor y)
 
-# Fonts
-font_large = pygame.font.SysFont('comicsansms', 48)
-font_medium = pygame.font.SysFont('comicsansms', 32)
-font_small = pygame.font.SysFont('comicsansms', 24)
+def sprite(entity_class):
+    entry = sprite_atlas.get(entity_class)
+    if entry is None:
+        surface, (anchor_x, anchor_y) = entity_class.render_sprite()
+        entry = sprite_atlas[entity_class] = (surface.convert_alpha(), anchor_x, anchor_y)
+    return entry
+
+def sprite_rect(entity_class, screen_x, screen_y):
+    surface, anchor_x, anchor_y = sprite(entity_class)
+    return surface.get_rect(topleft=(screen_x - anchor_x, screen_y - anchor_y))
+
+profiler = FrameProfiler()
 
 # Map generation
-class Tile:
-    def __init__(self, type, x, y, size):
-        self.type = type
-        self.x = x
-        self.y = y
-        self.size = size
+def paint_islands(grid, tile_x, tile_y, centers_x, centers_y, island_radius, rng):
+    # Draw islands onto grid, whose columns are at tiles tile_x and rows at tiles
+    # tile_y. Every island is worked out over the whole grid at once
+    num_islands = len(centers_x)
+    island_radius = np.asarray(island_radius)[:, None, None]
+    
+    # Distance from every tile to every island center, shape (islands, rows, columns)
+    distance = np.hypot(tile_x - np.asarray(centers_x)[:, None, None], tile_y - np.asarray(centers_y)[:, None, None])
+    shape = distance.shape
+    
+    # Add some noise to make the coastline irregular
+    noise = rng.uniform(-0.2, 0.2, shape)
+    on_island = distance < island_radius * (0.8 + noise)
+    
+    # Inner island is grass with some forest patches, the edge of the island is sand
+    terrain = np.where(rng.random(shape) < 0.2, FOREST_TILE, GRASS_TILE).astype(np.uint8)
+    terrain[distance >= island_radius * 0.5] = SAND_TILE
+    
+    # Add some rocky areas
+    terrain[rng.random(shape) < 0.05] = ROCK_TILE
+    
+    # Later islands are drawn over earlier ones, so each tile takes the last island covering it
+    last_island = num_islands - 1 - np.argmax(on_island[::-1], axis=0)
+    covered = on_island.any(axis=0)
+    island_tiles = np.take_along_axis(terrain, last_island[None], axis=0)[0]
+    grid[covered] = island_tiles[covered]
+
+def scatter_rocks(grid, rng):
+    # Add some random rock formations in water, about one per hundred tiles
+    num_tiles_y, num_tiles_x = grid.shape
+    num_rocks = num_tiles_x * num_tiles_y // 100
+    rocks_x = rng.integers(0, num_tiles_x, num_rocks)
+    rocks_y = rng.integers(0, num_tiles_y, num_rocks)
+    in_water = grid[rocks_y, rocks_x] == WATER_TILE
+    grid[rocks_y[in_water], rocks_x[in_water]] = ROCK_TILE
+
+@functools.lru_cache(maxsize=4096)
+def chunk_island(seed, chunk_x, chunk_y):
+    # The island centred in a world chunk as (center x, center y, radius) in tiles,
+    # or None. Islands never reach further than the neighbouring chunks, and the
+    # middle chunk always has one so there is land to start on
+    if not (0 <= chunk_x < WORLD_CHUNKS and 0 <= chunk_y < WORLD_CHUNKS):
+        return None
+    rng = np.random.default_rng((seed, chunk_x, chunk_y, 0))
+    if rng.random() >= WORLD_ISLAND_CHANCE and (chunk_x, chunk_y) != (WORLD_CHUNKS // 2, WORLD_CHUNKS // 2):
+        return None
+    center_x, center_y = rng.integers(0, WORLD_CHUNK_TILES, 2).tolist()
+    radius = int(rng.integers(WORLD_CHUNK_TILES // 2, WORLD_CHUNK_TILES + 1))
+    return (chunk_x * WORLD_CHUNK_TILES + center_x, chunk_y * WORLD_CHUNK_TILES + center_y, radius)
+
+def generate_chunk(seed, chunk_x, chunk_y):
+    # Tiles of one world chunk, the same every time for the same seed. The
+    # islands of the eight neighbouring chunks are painted too, so coastlines
+    # carry on across chunk edges
+    rng = np.random.default_rng((seed, chunk_x, chunk_y, 1))
+    grid = np.full((WORLD_CHUNK_TILES, WORLD_CHUNK_TILES), WATER_TILE, dtype=np.uint8)
+    islands = []
+    for neighbour_y in range(chunk_y - 1, chunk_y + 2):
+        for neighbour_x in range(chunk_x - 1, chunk_x + 2):
+            island = chunk_island(seed, neighbour_x, neighbour_y)
+            if island is not None:
+                islands.append(island)
+                
+    if islands:
+        centers_x, centers_y, island_radius = np.array(islands).T
+        first_x = chunk_x * WORLD_CHUNK_TILES
+        first_y = chunk_y * WORLD_CHUNK_TILES
+        tile_y, tile_x = np.ogrid[first_y:first_y + WORLD_CHUNK_TILES, first_x:first_x + WORLD_CHUNK_TILES]
+        paint_islands(grid, tile_x, tile_y, centers_x, centers_y, island_radius, rng)
+    scatter_rocks(grid, rng)
+    return grid
+
+class Tile(TileView):
+    __slots__ = ()
+    names = TILE_NAMES
+
+class SpawnIndex:
+    # Spawnable tiles for every set of excluded tile types, built once per map
+    def __init__(self, game_map):
+        self.game_map = game_map
+        self.buckets = {}  # frozenset of excluded tile ids -> flat tile indices
         
-    def draw(self, camera_x, camera_y):
-        # Only draw tiles that are visible on screen
-        screen_x = self.x - camera_x
-        screen_y = self.y - camera_y
-        
-        if -self.size <= screen_x <= WIDTH and -self.size <= screen_y <= HEIGHT:
-            if self.type == "water":
-                pygame.draw.rect(screen, WATER, (screen_x, screen_y, self.size, self.size))
-            elif self.type == "sand":
-                pygame.draw.rect(screen, SAND, (screen_x, screen_y, self.size, self.size))
-            elif self.type == "grass":
-                pygame.draw.rect(screen, GRASS, (screen_x, screen_y, self.size, self.size))
-            elif self.type == "forest":
-                pygame.draw.rect(screen, DARK_GREEN, (screen_x, screen_y, self.size, self.size))
-            elif self.type == "rock":
-                pygame.draw.rect(screen, ROCK, (screen_x, screen_y, self.size, self.size))
-
-class Map:
-    def __init__(self, width, height, tile_size):
+    def invalidate(self):
+        self.buckets.clear()
+        
+    def sample(self, count, exclude_tiles):
+        # Up to count distinct tile indices
+        key = frozenset(TILE_IDS[name] for name in exclude_tiles)
+        tiles = self.buckets.get(key)
+        if tiles is None:
+            tiles = np.flatnonzero(~np.isin(self.game_map.grid, list(key)))
+            self.buckets[key] = tiles
+            
+        picks = random.sample(range(len(tiles)), min(count, len(tiles)))
+        return tiles[picks]
+
+class BaseMap:
+    # What fixed and streamed maps have in common: the tile size, the seed and
+    # spawning on walkable tiles
+    streamed = False
+    
+    def __init__(self, tile_size, seed=None):
+        self.tile_size = tile_size
+        # Called with (tile_x, tile_y) whenever a tile changes, and by streamed maps
+        # with (tile_x, tile_y, tiles_x, tiles_y) for the area of every chunk that loads
+        self.tile_listeners = []
+        
+        # The same seed always gives the same map
+        if seed is None:
+            seed = random.randrange(2**32)
+        self.seed = seed
+        
+    def is_walkable(self, x, y, blocking_tiles=BLOCKING_TILES):
+        tile_type = self.tile_at(x, y)
+        return tile_type is not None and tile_type not in blocking_tiles
+    
+    def get_valid_position(self, size, exclude_tiles=None):
+        return self.get_valid_positions(1, size, exclude_tiles)[0]
+        
+    def get_valid_positions(self, count, size, exclude_tiles=None):
+        # Positions on count different tiles, as long as there are enough of them
+        if exclude_tiles is None:
+            exclude_tiles = ["water", "rock"]
+            
+        return tile_centers(self, self.spawn_index.sample(count, exclude_tiles), count)
+        
+    def stream_around(self, x, y):
+        # Only streamed maps load anything as the explorer moves
+        pass
+        
+    def close(self):
+        pass
+
+class Map(BaseMap):
+    # This game has no difficulty levels, saved maps record the default of 1
+    difficulty = 1
+    
+    def __init__(self, width, height, tile_size, seed=None, use_cache=True):
+        super().__init__(tile_size, seed)
         # Make the map 3 times bigger than the screen
         self.width = width * 3
         self.height = height * 3
-        self.tile_size = tile_size
-        self.tiles = []
-        self.generate_map()
+        self.num_tiles_x = self.width // tile_size
+        self.num_tiles_y = self.height // tile_size
+        # One tile type id per cell, indexed as grid[tile_y, tile_x]
+        self.grid = np.full((self.num_tiles_y, self.num_tiles_x), WATER_TILE, dtype=np.uint8)
+        self.tiles = TileList(self, Tile)
+        self.islands = []  # (center_x, center_y, radius) in tiles
+        self.terrain = TerrainCache(self, TILE_COLORS)
+        self.spawn_index = SpawnIndex(self)
+        self.rng = np.random.default_rng(self.seed)
+        
+        cache_path = MAP_FILE.cache_path(self)
+        if not (use_cache and self.load(cache_path)):
+            self.generate_map()
+            if use_cache:
+                self.save(cache_path)
+                MAP_FILE.prune_cache()
         
     def generate_map(self):
-        # Generate a more realistic island map
-        self.tiles = []
-        num_tiles_x = self.width // self.tile_size
-        num_tiles_y = self.height // self.tile_size
+        # Generate a more realistic island map. Every island is worked out over the
+        # whole grid at once with numpy, so the result only depends on self.rng
+        rng = self.rng
+        num_tiles_x = self.num_tiles_x
+        num_tiles_y = self.num_tiles_y
         
         # Start with all water
-        for y in range(num_tiles_y):
-            for x in range(num_tiles_x):
-                self.tiles.append(Tile("water", x * self.tile_size, y * self.tile_size, self.tile_size))
+        self.grid.fill(WATER_TILE)
         
         # Create multiple islands with Perlin noise (simplified)
-        num_islands = random.randint(2, 4)
+        num_islands = int(rng.integers(2, 5))
+        centers_x = rng.integers(num_tiles_x // 4, num_tiles_x * 3 // 4 + 1, num_islands)
+        centers_y = rng.integers(num_tiles_y // 4, num_tiles_y * 3 // 4 + 1, num_islands)
+        island_radius = min(num_tiles_x, num_tiles_y) // rng.integers(4, 7, num_islands)
+        self.islands = list(zip(centers_x.tolist(), centers_y.tolist(), island_radius.tolist()))
         
-        for island in range(num_islands):
-            center_x = random.randint(num_tiles_x // 4, num_tiles_x * 3 // 4)
-            center_y = random.randint(num_tiles_y // 4, num_tiles_y * 3 // 4)
-            island_radius = min(num_tiles_x, num_tiles_y) // random.randint(4, 6)
-            
-            for i, tile in enumerate(self.tiles):
-                tile_x = i % num_tiles_x
-                tile_y = i // num_tiles_x
-                
-                # Distance from center
-                distance = math.sqrt((tile_x - center_x)**2 + (tile_y - center_y)**2)
+        tile_y, tile_x = np.ogrid[0:num_tiles_y, 0:num_tiles_x]
+        paint_islands(self.grid, tile_x, tile_y, centers_x, centers_y, island_radius, rng)
+        scatter_rocks(self.grid, rng)
                 
-                # Add some noise to make the coastline irregular
-                noise = random.uniform(-0.2, 0.2)
-                
-                if distance < island_radius * (0.8 + noise):
-                    # Inner island is grass
-                    if distance < island_radius * 0.5:
-                        if random.random() < 0.2:
-                            self.tiles[i].type = "forest"  # Some forest patches
-                        else:
-                            self.tiles[i].type = "grass"
-                            
-                    # Edge of island is sand
-                    else:
-                        self.tiles[i].type = "sand"
-                        
-                    # Add some rocky areas
-                    if random.random() < 0.05:
-                        self.tiles[i].type = "rock"
-                        
-        # Add some random rock formations in water
-        for _ in range(num_tiles_x * num_tiles_y // 100):
-            x = random.randint(0, num_tiles_x - 1)
-            y = random.randint(0, num_tiles_y - 1)
-            index = y * num_tiles_x + x
-            if index < len(self.tiles) and self.tiles[index].type == "water":
-                self.tiles[index].type = "rock"
+        # The whole map changed, so every chunk has to be baked again
+        self.terrain.invalidate_all()
+        self.spawn_index.invalidate()
+        
+    def save(self, path):
+        islands = np.array(self.islands, dtype=np.uint16).reshape(-1, 3)
+        MAP_FILE.save(path, self, struct.pack("<H", len(islands)) + islands.tobytes() + self.grid.tobytes())
+            
+    def load(self, path):
+        # Fill this map from a saved file, returns False if the file is missing or doesn't match
+        payload = MAP_FILE.load(path, self)
+        if payload is None:
+            return False
+        try:
+            (num_islands,) = struct.unpack_from("<H", payload)
+            islands = np.frombuffer(payload, np.uint16, num_islands * 3, 2)
+            grid = np.frombuffer(payload, np.uint8, self.grid.size, 2 + islands.nbytes)
+        except (ValueError, struct.error):
+            return False
+            
+        self.islands = [tuple(island) for island in islands.reshape(-1, 3).tolist()]
+        self.grid[:] = grid.reshape(self.grid.shape)
+        self.terrain.invalidate_all()
+        self.spawn_index.invalidate()
+        return True
+        
+    def set_tile(self, tile_x, tile_y, tile_type):
+        # Change a single tile after generation, re-baking only its chunk
+        if isinstance(tile_type, str):
+            tile_type = TILE_IDS[tile_type]
+        self.grid[tile_y, tile_x] = tile_type
+        self.terrain.invalidate_tile(tile_x, tile_y)
+        self.spawn_index.invalidate()
+        for listener in self.tile_listeners:
+            listener(tile_x, tile_y)
+        
+    def tile_at(self, x, y):
+        # Tile type id under a pixel position, or None outside the map
+        tile_x = int(x // self.tile_size)
+        tile_y = int(y // self.tile_size)
+        if 0 <= tile_x < self.num_tiles_x and 0 <= tile_y < self.num_tiles_y:
+            return self.grid[tile_y, tile_x]
+        return None
     
-    def get_valid_position(self, size, exclude_tiles=None):
-        if exclude_tiles is None:
-            exclude_tiles = ["water", "rock"]
+    def sample(self, tile_x, tile_y):
+        # Tile types at every row in tile_y and column in tile_x
+        return self.grid[np.ix_(tile_y, tile_x)]
+        
+    def draw(self, camera_x, camera_y):
+        self.terrain.draw(camera_x, camera_y)
+
+class ResidentSpawnIndex:
+    # Spawnable tiles of a streamed map, only ever in the chunks that are loaded
+    def __init__(self, game_map):
+        self.game_map = game_map
+        
+    def invalidate(self):
+        pass
+        
+    def sample(self, count, exclude_tiles):
+        # Up to count distinct tiles, as flat indices into the whole world
+        excluded = [TILE_IDS[name] for name in exclude_tiles]
+        tiles = []
+        for (chunk_x, chunk_y), grid in self.game_map.chunks.items():
+            local_y, local_x = np.divmod(np.flatnonzero(~np.isin(grid, excluded)), WORLD_CHUNK_TILES)
+            tile_x = chunk_x * WORLD_CHUNK_TILES + local_x
+            tile_y = chunk_y * WORLD_CHUNK_TILES + local_y
+            tiles.append(tile_y * self.game_map.num_tiles_x + tile_x)
+        tiles = np.concatenate(tiles) if tiles else np.zeros(0, np.int64)
+        
+        picks = random.sample(range(len(tiles)), min(count, len(tiles)))
+        return tiles[picks]
+
+class StreamedTerrain(TerrainCache):
+    # Terrain of a streamed map, baked per world chunk. Chunks still on their
+    # way are open water
+    empty_color = WATER
+    
+    def __init__(self, game_map):
+        super().__init__(game_map, TILE_COLORS, (WORLD_CHUNK_TILES, WORLD_CHUNK_TILES), WORLD_BAKED_CHUNKS)
+        
+    def tiles(self, chunk_x, chunk_y):
+        return self.game_map.chunks.get((chunk_x, chunk_y))
+
+class StreamedMap(BaseMap):
+    # Endless map, made chunk by chunk around the explorer on a worker thread so
+    # the frame loop never waits for it. Loaded chunks are kept least recently
+    # used first and evicted past WORLD_RESIDENT_CHUNKS. Unedited chunks are simply
+    # generated again, edited ones are kept in memory
+    streamed = True
+    
+    def __init__(self, tile_size, seed=None):
+        super().__init__(tile_size, seed)
+        self.chunk_size = WORLD_CHUNK_TILES * tile_size  # In pixels
+        self.num_tiles_x = self.num_tiles_y = WORLD_CHUNKS * WORLD_CHUNK_TILES
+        self.width = self.num_tiles_x * tile_size
+        self.height = self.num_tiles_y * tile_size
+        self.spawn_index = ResidentSpawnIndex(self)
+        
+        self.chunks = OrderedDict()  # (chunk_x, chunk_y) -> tile grid
+        self.terrain = StreamedTerrain(self)
+        self.edited = set()  # Chunks changed by set_tile
+        self.kept = OrderedDict()  # Edited chunks that were evicted, oldest first
+        self.center_chunk = None
+        
+        # Only the main thread touches the chunks, the worker gets keys and hands back grids
+        self.requested = set()
+        self.requests = queue.Queue()
+        self.finished = queue.Queue()
+        self.worker = threading.Thread(target=self.work_forever, name="world", daemon=True)
+        self.worker.start()
+        
+        # The start area is waited for, there has to be land to put the explorer on
+        middle = WORLD_CHUNKS // 2 * self.chunk_size + self.chunk_size // 2
+        self.stream_around(middle, middle, wait=True)
+        
+    def work_forever(self):
+        # A chunk that fails to generate comes back as its exception, so the
+        # main thread raises it instead of waiting for the chunk forever
+        while True:
+            key = self.requests.get()
+            if key is None:
+                return
+            try:
+                grid = generate_chunk(self.seed, *key)
+            except Exception as error:
+                grid = error
+            self.finished.put((key, grid))
             
-        valid_tiles = [tile for tile in self.tiles if tile.type not in exclude_tiles]
+    def close(self):
+        self.requests.put(None)
         
-        if not valid_tiles:
-            return (self.width // 2, self.height // 2)
+    def stream_around(self, x, y, wait=False):
+        # Ask for the chunks near (x, y) once the explorer enters a new chunk, then
+        # take in whatever the worker has finished. wait blocks until all are in
+        center = (int(x // self.chunk_size), int(y // self.chunk_size))
+        if center != self.center_chunk:
+            self.center_chunk = center
+            for chunk_y in range(center[1] - WORLD_STREAM_RADIUS, center[1] + WORLD_STREAM_RADIUS + 1):
+                for chunk_x in range(center[0] - WORLD_STREAM_RADIUS, center[0] + WORLD_STREAM_RADIUS + 1):
+                    key = (chunk_x, chunk_y)
+                    if key in self.chunks:
+                        self.chunks.move_to_end(key)
+                    elif key in self.kept:
+                        self.add_chunk(key, self.kept.pop(key))
+                    elif key not in self.requested and 0 <= chunk_x < WORLD_CHUNKS and 0 <= chunk_y < WORLD_CHUNKS:
+                        self.requested.add(key)
+                        self.requests.put(key)
+                        
+        while self.requested:
+            try:
+                key, grid = self.finished.get(block=wait)
+            except queue.Empty:
+                break
+            self.requested.discard(key)
+            if isinstance(grid, Exception):
+                raise grid
+            self.add_chunk(key, grid)
             
-        chosen_tile = random.choice(valid_tiles)
-        return (chosen_tile.x + self.tile_size // 2, chosen_tile.y + self.tile_size // 2)
-    
+    def add_chunk(self, key, grid):
+        self.chunks[key] = grid
+        for listener in self.tile_listeners:
+            listener(key[0] * WORLD_CHUNK_TILES, key[1] * WORLD_CHUNK_TILES, WORLD_CHUNK_TILES, WORLD_CHUNK_TILES)
+            
+        while len(self.chunks) > WORLD_RESIDENT_CHUNKS:
+            old_key, old_grid = self.chunks.popitem(last=False)
+            self.terrain.invalidate_chunk(*old_key)
+            if old_key in self.edited:
+                self.kept[old_key] = old_grid
+                if len(self.kept) > WORLD_KEPT_CHUNKS:
+                    self.edited.discard(self.kept.popitem(last=False)[0])
+                
+    def set_tile(self, tile_x, tile_y, tile_type):
+        # Change a single tile of a loaded chunk
+        if isinstance(tile_type, str):
+            tile_type = TILE_IDS[tile_type]
+        key = (tile_x // WORLD_CHUNK_TILES, tile_y // WORLD_CHUNK_TILES)
+        grid = self.chunks.get(key)
+        if grid is None:
+            raise IndexError("tile is not in a loaded chunk")
+        grid[tile_y % WORLD_CHUNK_TILES, tile_x % WORLD_CHUNK_TILES] = tile_type
+        self.edited.add(key)
+        self.terrain.invalidate_tile(tile_x, tile_y)
+        for listener in self.tile_listeners:
+            listener(tile_x, tile_y)
+            
+    def tile_at(self, x, y):
+        # Tile type id under a pixel position, or None where nothing is loaded yet
+        tile_x = int(x // self.tile_size)
+        tile_y = int(y // self.tile_size)
+        grid = self.chunks.get((tile_x // WORLD_CHUNK_TILES, tile_y // WORLD_CHUNK_TILES))
+        if grid is None:
+            return None
+        return grid[tile_y % WORLD_CHUNK_TILES, tile_x % WORLD_CHUNK_TILES]
+        
+    def sample(self, tile_x, tile_y):
+        # Tile types at every row in tile_y and column in tile_x, open water where
+        # nothing is loaded. The chunks underneath are pasted together first
+        first_x = int(tile_x.min()) // WORLD_CHUNK_TILES
+        first_y = int(tile_y.min()) // WORLD_CHUNK_TILES
+        last_x = int(tile_x.max()) // WORLD_CHUNK_TILES
+        last_y = int(tile_y.max()) // WORLD_CHUNK_TILES
+        area = np.full(((last_y - first_y + 1) * WORLD_CHUNK_TILES, (last_x - first_x + 1) * WORLD_CHUNK_TILES),
+                       WATER_TILE, dtype=np.uint8)
+        for chunk_y in range(first_y, last_y + 1):
+            for chunk_x in range(first_x, last_x + 1):
+                grid = self.chunks.get((chunk_x, chunk_y))
+                if grid is not None:
+                    top = (chunk_y - first_y) * WORLD_CHUNK_TILES
+                    left = (chunk_x - first_x) * WORLD_CHUNK_TILES
+                    area[top:top + WORLD_CHUNK_TILES, left:left + WORLD_CHUNK_TILES] = grid
+        return area[np.ix_(tile_y - first_y * WORLD_CHUNK_TILES, tile_x - first_x * WORLD_CHUNK_TILES)]
+        
     def draw(self, camera_x, camera_y):
-        for tile in self.tiles:
-            tile.draw(camera_x, camera_y)
+        self.terrain.draw(camera_x, camera_y)
 
 class Explorer:
+    size = 20
+    
     def __init__(self, x, y):
         self.x = x
         self.y = y
         self.speed = 5
-        self.size = 20
         self.treasures = 0
         self.keys = 0
         self.hearts = 3
         
-    def draw(self, camera_x, camera_y):
-        # Calculate screen position
-        screen_x = self.x - camera_x
-        screen_y = self.y - camera_y
-        
-        # Draw explorer as a small person
+    @classmethod
+    def render_sprite(cls):
+        # A small person, the head above the body
+        size = cls.size
+        surface = pygame.Surface((size * 2 + 1, size * 3 + 6), pygame.SRCALPHA)
+        x, y = size, size * 2 + 5
         # Body
-        pygame.draw.circle(screen, BLUE, (screen_x, screen_y), self.size)
+        pygame.draw.circle(surface, BLUE, (x, y), size)
         # Head
-        pygame.draw.circle(screen, (255, 213, 170), (screen_x, screen_y - self.size - 5), self.size // 2)
+        pygame.draw.circle(surface, (255, 213, 170), (x, y - size - 5), size // 2)
         # Eyes
-        pygame.draw.circle(screen, BLACK, (screen_x - 5, screen_y - self.size - 5), 3)
-        pygame.draw.circle(screen, BLACK, (screen_x + 5, screen_y - self.size - 5), 3)
+        pygame.draw.circle(surface, BLACK, (x - 5, y - size - 5), 3)
+        pygame.draw.circle(surface, BLACK, (x + 5, y - size - 5), 3)
+        return surface, (x, y)
+        
+    def add_sprites(self, batch, camera_x, camera_y):
+        batch.append((sprite(Explorer)[0], self.screen_rect(camera_x, camera_y)))
+        
+    def draw(self, camera_x, camera_y):
+        screen.blit(sprite(Explorer)[0], self.screen_rect(camera_x, camera_y))
+        
+    def screen_rect(self, camera_x, camera_y):
+        # Area covered by the body and head
+        return sprite_rect(Explorer, self.x - camera_x, self.y - camera_y)
         
     def move(self, keys, game_map, camera_x, camera_y):
         new_x, new_y = self.x, self.y
@@ -185,60 +618,68 @@ class Explorer:
             new_y += self.speed
             
         # Check if new position is valid (not on water or rocks)
-        tile_x = new_x // game_map.tile_size
-        tile_y = new_y // game_map.tile_size
-        
-        if 0 <= tile_x < game_map.width // game_map.tile_size and 0 <= tile_y < game_map.height // game_map.tile_size:
-            tile_index = tile_y * (game_map.width // game_map.tile_size) + tile_x
-            
-            if 0 <= tile_index < len(game_map.tiles):
-                tile_type = game_map.tiles[tile_index].type
-                if tile_type not in ["water", "rock"]:
-                    self.x, self.y = new_x, new_y
+        if game_map.is_walkable(new_x, new_y):
+            self.x, self.y = new_x, new_y
             
     def collides_with(self, entity):
         distance = math.sqrt((self.x - entity.x)**2 + (self.y - entity.y)**2)
         return distance < self.size + entity.size
 
 class Treasure:
+    size = 20
+    
     def __init__(self, x, y):
         self.x = x
         self.y = y
-        self.size = 20
         
     def reset(self, x, y):
         self.x = x
         self.y = y
         
-    def draw(self, camera_x, camera_y):
-        # Calculate screen position
-        screen_x = self.x - camera_x
-        screen_y = self.y - camera_y
+    @classmethod
+    def render_sprite(cls):
+        # A treasure chest
+        size = cls.size
+        surface = pygame.Surface((size * 2 + 1, size * 3 // 2 + 6), pygame.SRCALPHA)
+        x, y = size, size * 3 // 4 + 5
+        chest_width = size * 2
+        chest_height = size * 1.5
+        
+        # Chest base
+        pygame.draw.rect(surface, BROWN, (x - chest_width//2, y - chest_height//2, chest_width, chest_height))
+        
+        # Chest lid
+        pygame.draw.rect(surface, BROWN, (x - chest_width//2, y - chest_height//2 - 5, chest_width, chest_height//3))
+        
+        # Gold highlights
+        pygame.draw.rect(surface, GOLD, (x - chest_width//2, y - chest_height//2, chest_width, chest_height), 2)
+        pygame.draw.rect(surface, GOLD, (x - chest_width//2, y - chest_height//2 - 5, chest_width, chest_height//3), 2)
+        
+        # Lock
+        pygame.draw.rect(surface, GOLD, (x - 5, y - chest_height//2 - 3, 10, 8))
+        return surface, (x, y)
         
+    def screen_rect(self, camera_x, camera_y):
+        # Area covered by the chest and its lid
+        return sprite_rect(Treasure, self.x - camera_x, self.y - camera_y)
+        
+    def add_sprites(self, batch, camera_x, camera_y):
         # Only draw if on screen
-        if -self.size*2 <= screen_x <= WIDTH + self.size*2 and -self.size*2 <= screen_y <= HEIGHT + self.size*2:
-            # Draw a treasure chest
-            chest_width = self.size * 2
-            chest_height = self.size * 1.5
-            
-            # Chest base
-            pygame.draw.rect(screen, BROWN, (screen_x - chest_width//2, screen_y - chest_height//2, chest_width, chest_height))
-            
-            # Chest lid
-            pygame.draw.rect(screen, BROWN, (screen_x - chest_width//2, screen_y - chest_height//2 - 5, chest_width, chest_height//3))
-            
-            # Gold highlights
-            pygame.draw.rect(screen, GOLD, (screen_x - chest_width//2, screen_y - chest_height//2, chest_width, chest_height), 2)
-            pygame.draw.rect(screen, GOLD, (screen_x - chest_width//2, screen_y - chest_height//2 - 5, chest_width, chest_height//3), 2)
+        rect = self.screen_rect(camera_x, camera_y)
+        if rect.colliderect(screen.get_rect()):
+            batch.append((sprite(Treasure)[0], rect))
             
-            # Lock
-            pygame.draw.rect(screen, GOLD, (screen_x - 5, screen_y - chest_height//2 - 3, 10, 8))
+    def draw(self, camera_x, camera_y):
+        batch = []
+        self.add_sprites(batch, camera_x, camera_y)
+        screen.blits(batch, doreturn=False)
 
 class Key:
+    size = 15
+    
     def __init__(self, x, y):
         self.x = x
         self.y = y
-        self.size = 15
         self.collected = False
         self.rotation = 0
         
@@ -247,105 +688,394 @@ class Key:
         self.y = y
         self.collected = False
         
-    def draw(self, camera_x, camera_y):
+    @classmethod
+    def render_sprite(cls):
+        # A more detailed key, anchored on the middle of its head
+        size = cls.size
+        surface = pygame.Surface((size * 3 // 2 + size // 4 + 1, size + 1), pygame.SRCALPHA)
+        x, y = size // 2, size // 2
+        # Key head
+        pygame.draw.circle(surface, GOLD, (x, y), size // 2)
+        
+        # Key shaft
+        pygame.draw.rect(surface, GOLD, (x, y, size, size // 4))
+        
+        # Key teeth
+        pygame.draw.rect(surface, GOLD, (x + size, y - size // 4, size // 4, size // 2))
+        pygame.draw.rect(surface, GOLD, (x + size * 0.7, y - size // 4, size // 4, size // 2))
+        return surface, (x, y)
+        
+    def screen_rect(self, camera_x, camera_y):
+        # Area covered by the head, shaft and teeth
+        return sprite_rect(Key, self.x - camera_x, self.y - camera_y)
+        
+    def add_sprites(self, batch, camera_x, camera_y):
         if not self.collected:
-            # Calculate screen position
-            screen_x = self.x - camera_x
-            screen_y = self.y - camera_y
-            
             # Only draw if on screen
-            if -self.size*2 <= screen_x <= WIDTH + self.size*2 and -self.size*2 <= screen_y <= HEIGHT + self.size*2:
-                # Draw a more detailed key
-                # Key head
-                pygame.draw.circle(screen, GOLD, (screen_x, screen_y), self.size // 2)
-                
-                # Key shaft
-                pygame.draw.rect(screen, GOLD, (screen_x, screen_y, self.size, self.size // 4))
+            rect = self.screen_rect(camera_x, camera_y)
+            if rect.colliderect(screen.get_rect()):
+                batch.append((sprite(Key)[0], rect))
                 
-                # Key teeth
-                pygame.draw.rect(screen, GOLD, (screen_x + self.size, screen_y - self.size // 4, self.size // 4, self.size // 2))
-                pygame.draw.rect(screen, GOLD, (screen_x + self.size * 0.7, screen_y - self.size // 4, self.size // 4, self.size // 2))
+    def draw(self, camera_x, camera_y):
+        batch = []
+        self.add_sprites(batch, camera_x, camera_y)
+        screen.blits(batch, doreturn=False)
 
 class Minimap:
-    def __init__(self, game_map, size=150):
+    # Each minimap pixel shows the tile under its centre, so building it costs the
+    # same however big the map is. With fog of war only explored pixels are shown.
+    # A streamed map has no edges, there the minimap shows a window the size of a
+    # fixed map that moves along with the explorer
+    def __init__(self, game_map, size=150, fog_of_war=False):
         self.game_map = game_map
         self.size = size
-        self.scale_x = size / game_map.width
-        self.scale_y = size / game_map.height
-        self.image = None
+        if game_map.streamed:
+            self.width, self.height = WIDTH * 3, HEIGHT * 3
+        else:
+            self.width, self.height = game_map.width, game_map.height
+        self.tiles_x = self.width // game_map.tile_size
+        self.tiles_y = self.height // game_map.tile_size
+        self.scale_x = size / self.width
+        self.scale_y = size / self.height
+        self.fog_of_war = fog_of_war
+        
+        # First tile column and row of the window. It moves in steps that are a
+        # whole number of minimap pixels, so explored pixels can move with it
+        self.origin_x = 0
+        self.origin_y = 0
+        self.step_x = self.tiles_x // math.gcd(self.tiles_x, size)
+        self.step_y = self.tiles_y // math.gcd(self.tiles_y, size)
+        
+        # Tile column and row, from the origin, sampled by every minimap column and row
+        self.sample_x = ((np.arange(size) + 0.5) * self.tiles_x // size).astype(np.intp)
+        self.sample_y = ((np.arange(size) + 0.5) * self.tiles_y // size).astype(np.intp)
+        
+        self.explored = np.full((size, size), not fog_of_war)  # Indexed [x, y] like surfarray
+        self.last_reveal = None
+        self.image = pygame.Surface((size, size))
         self.generate_minimap()
+        game_map.tile_listeners.append(self.update_tile)
         
     def generate_minimap(self):
-        # Create a surface for the minimap
-        self.image = pygame.Surface((self.size, self.size))
-        self.image.fill(BLACK)
-        
-        # Draw simplified map tiles
-        tile_size = self.game_map.tile_size * self.scale_x
-        for tile in self.game_map.tiles:
-            mini_x = tile.x * self.scale_x
-            mini_y = tile.y * self.scale_y
-            mini_size = max(1, int(tile_size))
-            
-            if tile.type == "water":
-                pygame.draw.rect(self.image, WATER, (mini_x, mini_y, mini_size, mini_size))
-            elif tile.type == "sand":
-                pygame.draw.rect(self.image, SAND, (mini_x, mini_y, mini_size, mini_size))
-            elif tile.type == "grass":
-                pygame.draw.rect(self.image, GRASS, (mini_x, mini_y, mini_size, mini_size))
-            elif tile.type == "forest":
-                pygame.draw.rect(self.image, DARK_GREEN, (mini_x, mini_y, mini_size, mini_size))
-            elif tile.type == "rock":
-                pygame.draw.rect(self.image, ROCK, (mini_x, mini_y, mini_size, mini_size))
+        # Downsample the whole window in one go
+        self.colors = TILE_COLORS[self.game_map.sample(self.origin_x + self.sample_x, self.origin_y + self.sample_y).T]
+        self.redraw(slice(None), slice(None))
+        
+    def redraw(self, columns, rows):
+        # Copy terrain colors into part of the image, fog where nothing is explored yet
+        colors = self.colors[columns, rows]
+        explored = self.explored[columns, rows, np.newaxis]
+        pixels = pygame.surfarray.pixels3d(self.image)
+        pixels[columns, rows] = np.where(explored, colors, FOG)
+        del pixels  # Unlocks the surface
+        
+    def update_tile(self, tile_x, tile_y, tiles_x=1, tiles_y=1):
+        # Recolor only the minimap pixels that sample the changed tiles
+        tile_x -= self.origin_x
+        tile_y -= self.origin_y
+        columns = slice(*np.searchsorted(self.sample_x, [tile_x, tile_x + tiles_x]))
+        rows = slice(*np.searchsorted(self.sample_y, [tile_y, tile_y + tiles_y]))
+        if columns.start == columns.stop or rows.start == rows.stop:
+            return
+        self.colors[columns, rows] = TILE_COLORS[self.game_map.sample(self.origin_x + self.sample_x[columns],
+                                                                      self.origin_y + self.sample_y[rows]).T]
+        self.redraw(columns, rows)
+        
+    def follow(self, x, y):
+        # Move a streamed map's window once (x, y) is a quarter of it from the middle.
+        # Explored pixels move along, the ones that scroll out are forgotten
+        tile_x = int(x // self.game_map.tile_size) - self.origin_x - self.tiles_x // 2
+        tile_y = int(y // self.game_map.tile_size) - self.origin_y - self.tiles_y // 2
+        shift_x = tile_x // self.step_x * self.step_x if abs(tile_x) > self.tiles_x // 4 else 0
+        shift_y = tile_y // self.step_y * self.step_y if abs(tile_y) > self.tiles_y // 4 else 0
+        if not (shift_x or shift_y):
+            return
+            
+        self.origin_x += shift_x
+        self.origin_y += shift_y
+        pixels_x = shift_x * self.size // self.tiles_x
+        pixels_y = shift_y * self.size // self.tiles_y
+        explored = np.full_like(self.explored, not self.fog_of_war)
+        if abs(pixels_x) < self.size and abs(pixels_y) < self.size:
+            explored[max(-pixels_x, 0):self.size - max(pixels_x, 0), max(-pixels_y, 0):self.size - max(pixels_y, 0)] = \
+                self.explored[max(pixels_x, 0):self.size - max(-pixels_x, 0), max(pixels_y, 0):self.size - max(-pixels_y, 0)]
+        self.explored = explored
+        self.last_reveal = None
+        self.generate_minimap()
+        
+    def reveal(self, x, y, radius=FOG_REVEAL_RADIUS):
+        # Uncover the minimap around a map position, only touching the pixels near it
+        if self.game_map.streamed:
+            self.follow(x, y)
+        if not self.fog_of_war:
+            return
+        center_x = int((x - self.origin_x * self.game_map.tile_size) * self.scale_x)
+        center_y = int((y - self.origin_y * self.game_map.tile_size) * self.scale_y)
+        if (center_x, center_y) == self.last_reveal:
+            return
+        self.last_reveal = (center_x, center_y)
+        
+        radius_x = int(radius * self.scale_x) + 1
+        radius_y = int(radius * self.scale_y) + 1
+        columns = slice(max(center_x - radius_x, 0), min(center_x + radius_x + 1, self.size))
+        rows = slice(max(center_y - radius_y, 0), min(center_y + radius_y + 1, self.size))
+        offset_x = (np.arange(columns.start, columns.stop) - center_x)[:, np.newaxis] / radius_x
+        offset_y = (np.arange(rows.start, rows.stop) - center_y)[np.newaxis, :] / radius_y
+        inside = offset_x**2 + offset_y**2 <= 1
+        if (inside & ~self.explored[columns, rows]).any():
+            self.explored[columns, rows] |= inside
+            self.redraw(columns, rows)
+            
+    def is_explored(self, x, y):
+        mini_x = int((x - self.origin_x * self.game_map.tile_size) * self.scale_x)
+        mini_y = int((y - self.origin_y * self.game_map.tile_size) * self.scale_y)
+        return 0 <= mini_x < self.size and 0 <= mini_y < self.size and self.explored[mini_x, mini_y]
         
     def draw(self, explorer, treasure, key, camera_x, camera_y):
         # Draw minimap background
         screen.blit(self.image, (WIDTH - self.size - 10, 10))
         
+        # Map positions are drawn relative to the window's corner, clipped to the minimap
+        left = WIDTH - self.size - 10 - self.origin_x * self.game_map.tile_size * self.scale_x
+        top = 10 - self.origin_y * self.game_map.tile_size * self.scale_y
+        screen.set_clip(MINIMAP_RECT)
+        
         # Draw camera view area on minimap
-        view_x = (camera_x / self.game_map.width) * self.size
-        view_y = (camera_y / self.game_map.height) * self.size
-        view_width = (WIDTH / self.game_map.width) * self.size
-        view_height = (HEIGHT / self.game_map.height) * self.size
-        pygame.draw.rect(screen, WHITE, (WIDTH - self.size - 10 + view_x, 10 + view_y, view_width, view_height), 1)
+        view_width = WIDTH * self.scale_x
+        view_height = HEIGHT * self.scale_y
+        pygame.draw.rect(screen, WHITE, (left + camera_x * self.scale_x, top + camera_y * self.scale_y, view_width, view_height), 1)
         
         # Draw explorer on minimap
-        mini_explorer_x = WIDTH - self.size - 10 + explorer.x * self.scale_x
-        mini_explorer_y = 10 + explorer.y * self.scale_y
+        mini_explorer_x = left + explorer.x * self.scale_x
+        mini_explorer_y = top + explorer.y * self.scale_y
         pygame.draw.circle(screen, BLUE, (mini_explorer_x, mini_explorer_y), 3)
         
-        # Draw treasure on minimap
-        mini_treasure_x = WIDTH - self.size - 10 + treasure.x * self.scale_x
-        mini_treasure_y = 10 + treasure.y * self.scale_y
-        pygame.draw.rect(screen, GOLD, (mini_treasure_x - 2, mini_treasure_y - 2, 4, 4))
+        # Draw treasure on minimap, once its area has been explored
+        if self.is_explored(treasure.x, treasure.y):
+            mini_treasure_x = left + treasure.x * self.scale_x
+            mini_treasure_y = top + treasure.y * self.scale_y
+            pygame.draw.rect(screen, GOLD, (mini_treasure_x - 2, mini_treasure_y - 2, 4, 4))
         
-        # Draw key on minimap if not collected
-        if not key.collected:
-            mini_key_x = WIDTH - self.size - 10 + key.x * self.scale_x
-            mini_key_y = 10 + key.y * self.scale_y
+        # Draw key on minimap if not collected and explored
+        if not key.collected and self.is_explored(key.x, key.y):
+            mini_key_x = left + key.x * self.scale_x
+            mini_key_y = top + key.y * self.scale_y
             pygame.draw.circle(screen, WHITE, (mini_key_x, mini_key_y), 2)
+        screen.set_clip(None)
 
-class Game:
+class KeyState(frozenset):
+    # Stands in for pygame.key.get_pressed(): keys[pygame.K_LEFT] is True when held
+    __getitem__ = frozenset.__contains__
+
+class ScriptedInput:
+    # Replaces the keyboard with a seeded random walk, so headless runs and
+    # benchmarks press exactly the same keys every time
+    DIRECTIONS = [(), (pygame.K_LEFT,), (pygame.K_RIGHT,), (pygame.K_UP,), (pygame.K_DOWN,),
+                  (pygame.K_LEFT, pygame.K_UP), (pygame.K_LEFT, pygame.K_DOWN),
+                  (pygame.K_RIGHT, pygame.K_UP), (pygame.K_RIGHT, pygame.K_DOWN)]
+    
+    def __init__(self, seed=0, min_hold=10, max_hold=60):
+        self.rng = random.Random(seed)
+        self.min_hold = min_hold
+        self.max_hold = max_hold
+        self.keys = KeyState()
+        self.hold = 0
+        
+    def get_pressed(self):
+        # Called once per frame, holds each direction for a random number of frames
+        if self.hold <= 0:
+            self.keys = KeyState(self.rng.choice(self.DIRECTIONS))
+            self.hold = self.rng.randint(self.min_hold, self.max_hold)
+        self.hold -= 1
+        return self.keys
+
+class InputRecorder:
+    # Passes the game's controls through and writes the input of every frame to
+    # a replay log, see REPLAY_HEADER. Digits are recorded by the character they
+    # typed, so keypad digits play back as the same answer
+    def __init__(self, path, game, random_seed):
+        self.controls = game.controls
+        self.file = open(path, "wb")
+        self.file.write(REPLAY_HEADER.pack(REPLAY_FILE_MAGIC, REPLAY_FILE_VERSION, game.seed, random_seed,
+                                           *game.map_size, game.minimap.fog_of_war, game.map.streamed, game.state))
+        self.compressor = zlib.compressobj()
+        self.held = 0
+        self.presses = bytearray()
+        self.frames = 0
+        
+    def get_events(self):
+        events = pygame.event.get()
+        for event in events:
+            if event.type == pygame.KEYDOWN:
+                if event.unicode in REPLAY_DIGIT_CODES:
+                    code = REPLAY_DIGIT_CODES[event.unicode]
+                else:
+                    code = REPLAY_KEY_CODES.get(event.key)
+                if code is not None and len(self.presses) < REPLAY_MAX_PRESSES:
+                    self.presses.append(code)
+        return events
+        
+    def get_pressed(self):
+        keys = self.controls.get_pressed()
+        self.held = sum(1 << bit for bit, key in enumerate(REPLAY_HELD_KEYS) if keys[key])
+        return keys
+        
+    def end_frame(self, ticks):
+        # A frame that ran more ticks than a record holds is written as several
+        # records, the key presses go with the first and the rest are marked as
+        # continuing it, so a replay still counts them as one frame
+        continued = 0
+        while True:
+            record_ticks = min(ticks, REPLAY_MAX_TICKS)
+            record = REPLAY_FRAME.pack(continued | self.held | record_ticks << 4 | len(self.presses) << 8)
+            self.file.write(self.compressor.compress(record + self.presses))
+            self.presses.clear()
+            continued = REPLAY_CONTINUED
+            ticks -= record_ticks
+            if not ticks:
+                break
+        self.frames += 1
+        if self.frames % REPLAY_FLUSH_FRAMES == 0:
+            self.file.write(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+            self.file.flush()
+            
+    def close(self):
+        self.file.write(self.compressor.flush())
+        self.file.close()
+
+class InputReplay:
+    # Controls that play a replay log back frame by frame: the held keys for
+    # every tick of the frame and the recorded key presses as events
+    def __init__(self, path):
+        data = Path(path).read_bytes()
+        (magic, version, self.seed, self.random_seed, width, height, fog_of_war, infinite,
+         self.state) = REPLAY_HEADER.unpack_from(data)
+        if (magic, version) != (REPLAY_FILE_MAGIC, REPLAY_FILE_VERSION):
+            raise ValueError(f"{path} is not a replay log")
+        self.map_size = (width, height)
+        self.fog_of_war = bool(fog_of_war)
+        self.infinite = bool(infinite)
+        
+        # A recording cut short by a crash still plays up to its last flush
+        self.data = zlib.decompressobj().decompress(data[REPLAY_HEADER.size:])
+        self.offset = 0
+        self.frame = 0
+        self.held_states = [KeyState(key for bit, key in enumerate(REPLAY_HELD_KEYS) if held >> bit & 1)
+                            for held in range(16)]
+        self.press_events = [pygame.event.Event(pygame.KEYDOWN, key=key, unicode=text) for key, text in REPLAY_PRESSES]
+        self.keys = self.held_states[0]
+        self.events = []
+        
+    def read_record(self):
+        # The next record and its key presses, None at the end of the log
+        start = self.offset + REPLAY_FRAME.size
+        if start > len(self.data):
+            return None
+        record, = REPLAY_FRAME.unpack_from(self.data, self.offset)
+        count = record >> 8 & REPLAY_MAX_PRESSES
+        presses = self.data[start:start + count]
+        if len(presses) < count:
+            return None
+        self.offset = start + count
+        return record, presses
+        
+    def next_frame(self):
+        # Ticks the next recorded frame ran, None at the end of the log. The
+        # records continuing a split frame are added to it
+        read = self.read_record()
+        if read is None:
+            return None
+        record, presses = read
+        self.keys = self.held_states[record & 0xF]
+        self.events = [self.press_events[code] for code in presses]
+        ticks = record >> 4 & 0xF
+        while True:
+            offset = self.offset
+            read = self.read_record()
+            if read is None or not read[0] & REPLAY_CONTINUED:
+                self.offset = offset
+                break
+            ticks += read[0] >> 4 & 0xF
+        self.frame += 1
+        return ticks
+        
+    def get_events(self):
+        # The window can still be closed while a replay plays
+        events = [event for event in pygame.event.get() if event.type == pygame.QUIT] + self.events
+        self.events = []
+        return events
+        
+    def get_pressed(self):
+        return self.keys
+
+class ModalLayer:
+    # Snapshot of the screen behind a modal screen: the frozen map, darkened, with
+    # the modal's static parts on top. It is only drawn again when its key changes,
+    # every other frame starts with one blit of it
     def __init__(self):
+        self.surface = None
+        self.shade = None
+        self.key = None
+        
+    def invalidate(self):
+        self.key = None
+        
+    def draw(self, key, darkness, game_map, camera_x, camera_y, draw_static):
+        if self.surface is None:
+            self.surface = pygame.Surface((WIDTH, HEIGHT)).convert()
+            self.shade = pygame.Surface((WIDTH, HEIGHT)).convert()
+            self.shade.fill(BLACK)
+            
+        if key == self.key:
+            screen.blit(self.surface, (0, 0))
+            return
+            
+        self.key = key
+        with profiler.section("map"):
+            game_map.draw(camera_x, camera_y)
+        self.shade.set_alpha(darkness)
+        screen.blit(self.shade, (0, 0))
+        draw_static()
+        self.surface.blit(screen, (0, 0))
+
+modal_layer = ModalLayer()
+
+class Game:
+    def __init__(self, seed=None, map_size=(WIDTH, HEIGHT), controls=None, fog_of_war=False, infinite=False,
+                 challenge_rng=None):
         self.state = MENU
-        self.map = Map(WIDTH, HEIGHT, 20)
+        if infinite:
+            self.map = StreamedMap(20, seed)
+        else:
+            self.map = Map(*map_size, 20, seed)
+        self.seed = self.map.seed
+        self.map_size = map_size
+        self.controls = controls or pygame.key  # Anything with a get_pressed(), and maybe a get_events()
+        # Recorded and replayed games make their challenges from this instead of
+        # the pool, whose worker thread would hand them out in a different order
+        self.challenge_rng = challenge_rng
         
         # Initialize camera position
         self.camera_x = 0
         self.camera_y = 0
         
-        explorer_pos = self.map.get_valid_position(20)
+        # Explorer, treasure and key all start on different tiles
+        explorer_pos, treasure_pos, key_pos = self.map.get_valid_positions(3, 20)
         self.explorer = Explorer(*explorer_pos)
-        
-        treasure_pos = self.map.get_valid_position(20)
         self.treasure = Treasure(*treasure_pos)
-        
-        key_pos = self.map.get_valid_position(15)
         self.key = Key(*key_pos)
         
-        self.minimap = Minimap(self.map)
+        # Camera and explorer as of the previous tick, rendering blends between
+        # them and the current tick by alpha
+        self.previous = (self.camera_x, self.camera_y, self.explorer.x, self.explorer.y)
+        self.alpha = 1.0
+        
+        self.minimap = Minimap(self.map, fog_of_war=fog_of_war)
+        self.minimap.reveal(self.explorer.x, self.explorer.y)
+        modal_layer.invalidate()
         
         self.current_challenge = None
+        self.challenge_lines = ()
         self.challenge_type = None
         self.secret_answer = None
         self.explorer_answer = ""
@@ -353,79 +1083,46 @@ class Game:
         self.rank = 1
         self.adventure_points = 0
         self.challenge_timer = 0
-        self.challenge_time_limit = 20 * 60  # 20 seconds in frames at 60 FPS
+        self.challenge_time_limit = 20 * TICK_RATE  # 20 seconds in ticks
         
     def generate_challenge(self):
-        self.challenge_type = random.randint(0, 6)
+        # Challenges come ready made, text already wrapped, from the pool for this rank
+        if self.challenge_rng:
+            pool = get_challenge_pool()
+            challenge = pool.lay_out(pool.make(self.challenge_rng, self.rank))
+        else:
+            challenge = get_challenge_pool().take(self.rank)
+        self.challenge_type = challenge.kind
+        self.current_challenge = challenge.text
+        self.challenge_lines = challenge.lines
+        self.secret_answer = challenge.answer
         self.explorer_answer = ""
         self.challenge_result = None
         self.challenge_timer = self.challenge_time_limit
-        
-        if self.challenge_type == COLLECTING:
-            a = random.randint(1, 10 * self.rank)
-            b = random.randint(1, 10 * self.rank)
-            self.current_challenge = f"The treasure chest needs a special code! Count {a} glowing stones and {b} magical pebbles together to find the magic total."
-            self.secret_answer = str(a + b)
-            
-        elif self.challenge_type == SPENDING:
-            a = random.randint(10 * self.rank, 20 * self.rank)
-            b = random.randint(1, a)
-            self.current_challenge = f"Oh no! The treasure is locked! If you had {a} gold coins and spent {b} coins on supplies, how many coins remain in your pouch?"
-            self.secret_answer = str(a - b)
-            
-        elif self.challenge_type == TREASURES:
-            a = random.randint(1, 5 + self.rank)
-            b = random.randint(1, 10)
-            self.current_challenge = f"You found {a} treasure chests, each with {b} gems. How many gems have you discovered in total?"
-            self.secret_answer = str(a * b)
-            
-        elif self.challenge_type == SHARING:
-            b = random.randint(1, 5 + self.rank)
-            a = b * random.randint(1, 10)
-            self.current_challenge = f"You need to share {a} gold coins equally among {b} crew members. How many coins does each crew member receive?"
-            self.secret_answer = str(a // b)
-            
-        elif self.challenge_type == MAPPING:
-            a = random.randint(30, 100)
-            self.current_challenge = f"Map reading: About how many paces to the nearest ten is {a} paces to the treasure?"
-            rounded = round(a / 10) * 10
-            self.secret_answer = str(rounded)
-            
-        elif self.challenge_type == CODES:
-            start = random.randint(1, 5)
-            step = random.randint(2, 5)
-            sequence = [start + step*i for i in range(4)]
-            self.current_challenge = f"Decode the secret sequence: {sequence[0]}, {sequence[1]}, {sequence[2]}, {sequence[3]}, ?"
-            self.secret_answer = str(sequence[3] + step)
-            
-        elif self.challenge_type == SECRETS:
-            shapes = ["triangle", "square", "pentagon", "hexagon"]
-            shape = random.choice(shapes)
-            if shape == "triangle":
-                self.current_challenge = "How many edges does a triangular amulet have?"
-                self.secret_answer = "3"
-            elif shape == "square":
-                self.current_challenge = "How many edges does a square treasure map have?"
-                self.secret_answer = "4"
-            elif shape == "pentagon":
-                self.current_challenge = "How many edges does a pentagonal coin have?"
-                self.secret_answer = "5"
-            elif shape == "hexagon":
-                self.current_challenge = "How many edges does a hexagonal gem have?"
-                self.secret_answer = "6"
     
+    def restart(self, seed):
+        # A new game with the same controls and options
+        self.map.close()
+        self.__init__(seed, self.map_size, self.controls, self.minimap.fog_of_war, self.map.streamed, self.challenge_rng)
+        
     def handle_events(self):
-        for event in pygame.event.get():
+        for event in getattr(self.controls, "get_events", pygame.event.get)():
             if event.type == pygame.QUIT:
                 pygame.quit()
                 sys.exit()
                 
             if event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_F3 and profiler.enabled:
+                    profiler.show_overlay = not profiler.show_overlay
+                    
                 if self.state == MENU and event.key == pygame.K_SPACE:
                     self.state = PLAYING
                     
                 elif self.state == GAME_OVER and event.key == pygame.K_SPACE:
-                    self.__init__()  # Reset the game
+                    self.restart(None)  # Reset the game
+                    
+                elif self.state == GAME_OVER and event.key == pygame.K_r:
+                    self.restart(self.seed)  # Replay the same islands
                     
                 elif self.state == CHALLENGE:
                     if event.key == pygame.K_RETURN:
@@ -435,13 +1132,12 @@ class Game:
                             self.explorer.treasures += 1
                             if self.explorer.treasures % 5 == 0:
                                 self.rank += 1
+                                get_challenge_pool().warm(self.rank + 1)
                             self.state = PLAYING
                             
                             # Reset treasure and key in new positions
-                            treasure_pos = self.map.get_valid_position(20)
+                            treasure_pos, key_pos = self.map.get_valid_positions(2, 20)
                             self.treasure.reset(*treasure_pos)
-                            
-                            key_pos = self.map.get_valid_position(15)
                             self.key.reset(*key_pos)
                         else:
                             self.challenge_result = False
@@ -456,8 +1152,12 @@ class Game:
                         self.explorer_answer += event.unicode
     
     def update(self):
+        # One fixed simulation tick
+        self.previous = (self.camera_x, self.camera_y, self.explorer.x, self.explorer.y)
+        
         if self.state == PLAYING:
-            keys = pygame.key.get_pressed()
+            self.map.stream_around(self.explorer.x, self.explorer.y)
+            keys = self.controls.get_pressed()
             self.explorer.move(keys, self.map, self.camera_x, self.camera_y)
             
             # Update camera to follow explorer
@@ -467,16 +1167,18 @@ class Game:
             # Keep camera within map bounds
             self.camera_x = max(0, min(self.camera_x, self.map.width - WIDTH))
             self.camera_y = max(0, min(self.camera_y, self.map.height - HEIGHT))
+            self.minimap.reveal(self.explorer.x, self.explorer.y)
             
-            # Check for key collection
-            if not self.key.collected and self.explorer.collides_with(self.key):
-                self.key.collected = True
-                self.explorer.keys += 1
+            with profiler.section("collisions"):
+                # Check for key collection
+                if not self.key.collected and self.explorer.collides_with(self.key):
+                    self.key.collected = True
+                    self.explorer.keys += 1
                 
-            # Check for treasure collection
-            if self.key.collected and self.explorer.collides_with(self.treasure):
-                self.state = CHALLENGE
-                self.generate_challenge()
+                # Check for treasure collection
+                if self.key.collected and self.explorer.collides_with(self.treasure):
+                    self.state = CHALLENGE
+                    self.generate_challenge()
                 
         elif self.state == CHALLENGE:
             self.challenge_timer -= 1
@@ -488,17 +1190,61 @@ class Game:
                 else:
                     self.generate_challenge()  # Try again
     
+    def view(self):
+        # Camera to draw the world with and camera to draw the explorer with,
+        # interpolated between the last two ticks
+        camera_x, camera_y, explorer_x, explorer_y = self.previous
+        alpha = self.alpha
+        view_x = round(camera_x + (self.camera_x - camera_x) * alpha)
+        view_y = round(camera_y + (self.camera_y - camera_y) * alpha)
+        explorer_x += (self.explorer.x - explorer_x) * alpha
+        explorer_y += (self.explorer.y - explorer_y) * alpha
+        return (view_x, view_y, round(view_x - explorer_x + self.explorer.x),
+                round(view_y - explorer_y + self.explorer.y))
+        
+    def frame_signature(self):
+        # Everything that decides what the current frame looks like. Two frames
+        # with the same signature are identical on screen
+        if self.state == PLAYING:
+            view = self.view()
+            return (PLAYING, view[:2], view[2:], (self.explorer.x, self.explorer.y),
+                    (self.treasure.x, self.treasure.y), (self.key.x, self.key.y), self.key.collected,
+                    self.adventure_points, self.rank, self.explorer.treasures, self.explorer.hearts)
+        elif self.state == CHALLENGE:
+            return (CHALLENGE, self.current_challenge, self.explorer_answer, self.challenge_timer)
+        elif self.state == GAME_OVER:
+            return (GAME_OVER, self.adventure_points, self.explorer.treasures, self.rank, self.seed)
+        return (self.state,)
+        
+    def sprite_rects(self):
+        # Screen areas of everything that moves around while playing
+        camera_x, camera_y, explorer_camera_x, explorer_camera_y = self.view()
+        rects = [self.explorer.screen_rect(explorer_camera_x, explorer_camera_y),
+                 self.treasure.screen_rect(camera_x, camera_y)]
+        if not self.key.collected:
+            rects.append(self.key.screen_rect(camera_x, camera_y))
+        return rects
+        
     def draw(self):
+        self.draw_frame()
+        profiler.draw_overlay()
+        
+        # Update the display
+        pygame.display.flip()
+        
+    def draw_frame(self):
         # Clear the screen
         screen.fill(BLACK)
         
+        camera_x, camera_y, explorer_camera_x, explorer_camera_y = self.view()
+        
         if self.state == MENU:
             # Draw title
-            title = font_large.render("Treasure Hunter Adventure", True, GOLD)
+            title = render_text(font_large, "Treasure Hunter Adventure", GOLD)
             screen.blit(title, (WIDTH//2 - title.get_width()//2, HEIGHT//4))
             
             # Draw start message
-            start_msg = font_medium.render("Press SPACE to start your adventure!", True, WHITE)
+            start_msg = render_text(font_medium, "Press SPACE to start your adventure!", WHITE)
             screen.blit(start_msg, (WIDTH//2 - start_msg.get_width()//2, HEIGHT//2))
             
             # Draw instructions
@@ -511,144 +1257,306 @@ class Game:
             
             y_offset = HEIGHT * 2 // 3
             for instruction in instructions:
-                text = font_small.render(instruction, True, WHITE)
+                text = render_text(font_small, instruction, WHITE)
                 screen.blit(text, (WIDTH//2 - text.get_width()//2, y_offset))
                 y_offset += 40
                 
         elif self.state == PLAYING:
             # Draw map
-            self.map.draw(self.camera_x, self.camera_y)
+            with profiler.section("map"):
+                self.map.draw(camera_x, camera_y)
             
             # Draw game elements
-            self.treasure.draw(self.camera_x, self.camera_y)
-            if not self.key.collected:
-                self.key.draw(self.camera_x, self.camera_y)
-            self.explorer.draw(self.camera_x, self.camera_y)
+            with profiler.section("entities"):
+                batch = []
+                self.treasure.add_sprites(batch, camera_x, camera_y)
+                self.key.add_sprites(batch, camera_x, camera_y)
+                self.explorer.add_sprites(batch, explorer_camera_x, explorer_camera_y)
+                screen.blits(batch, doreturn=False)
                 
             # Draw minimap
-            self.minimap.draw(self.explorer, self.treasure, self.key, self.camera_x, self.camera_y)
+            with profiler.section("minimap"):
+                self.minimap.draw(self.explorer, self.treasure, self.key, camera_x, camera_y)
                 
             # Draw HUD
-            score_text = font_small.render(f"Adventure Points: {self.adventure_points}", True, WHITE)
-            level_text = font_small.render(f"Explorer Rank: {self.rank}", True, WHITE)
-            treasures_text = font_small.render(f"Treasures: {self.explorer.treasures}", True, WHITE)
-            lives_text = font_small.render(f"Hearts: {self.explorer.hearts}", True, WHITE)
-            keys_text = font_small.render(f"Magic Key: {'Yes' if self.key.collected else 'No'}", True, WHITE)
-            location_text = font_small.render(f"Location: ({int(self.explorer.x)}, {int(self.explorer.y)})", True, WHITE)
-            
-            # Draw HUD background
-            pygame.draw.rect(screen, BLACK, (0, 0, 200, 190))
-            
-            screen.blit(score_text, (10, 10))
-            screen.blit(level_text, (10, 40))
-            screen.blit(treasures_text, (10, 70))
-            screen.blit(lives_text, (10, 100))
-            screen.blit(keys_text, (10, 130))
-            screen.blit(location_text, (10, 160))
-            
-        elif self.state == CHALLENGE:
-            # Draw game map with reduced opacity in background
-            self.map.draw(self.camera_x, self.camera_y)
-            
-            # Semi-transparent overlay
-            overlay = pygame.Surface((WIDTH, HEIGHT), pygame.SRCALPHA)
-            overlay.fill((0, 0, 0, 180))  # Black with alpha
-            screen.blit(overlay, (0, 0))
-            
-            # Draw challenge background - antique scroll
-            scroll_width = WIDTH*2//3
-            scroll_height = HEIGHT*2//3
-            scroll_x = WIDTH//2 - scroll_width//2
-            scroll_y = HEIGHT//2 - scroll_height//2
-            
-            # Scroll background
-            pygame.draw.rect(screen, (244, 227, 188), (scroll_x, scroll_y, scroll_width, scroll_height))
-            
-            # Scroll edges
-            pygame.draw.rect(screen, (198, 169, 91), (scroll_x, scroll_y, scroll_width, scroll_height), 5)
-            
-            # Scroll decorative elements
-            pygame.draw.circle(screen, (198, 169, 91), (scroll_x + scroll_width//2, scroll_y + 20), 10)
-            pygame.draw.circle(screen, (198, 169, 91), (scroll_x + scroll_width//2, scroll_y + scroll_height - 20), 10)
-            
-            # Draw challenge text
-            challenge_text = font_medium.render("Ancient Riddle!", True, BROWN)
-            screen.blit(challenge_text, (WIDTH//2 - challenge_text.get_width()//2, HEIGHT//4))
-            
-            # Wrap challenge text to fit the box
-            words = self.current_challenge.split()
-            lines = []
-            current_line = ""
-            
-            for word in words:
-                test_line = current_line + word + " "
-                test_width = font_small.size(test_line)[0]
+            with profiler.section("hud"):
+                score_text = render_text(font_small, f"Adventure Points: {self.adventure_points}", WHITE)
+                level_text = render_text(font_small, f"Explorer Rank: {self.rank}", WHITE)
+                treasures_text = render_text(font_small, f"Treasures: {self.explorer.treasures}", WHITE)
+                lives_text = render_text(font_small, f"Hearts: {self.explorer.hearts}", WHITE)
+                keys_text = render_text(font_small, f"Magic Key: {'Yes' if self.key.collected else 'No'}", WHITE)
+                location_text = render_text(font_small, f"Location: ({int(self.explorer.x)}, {int(self.explorer.y)})", WHITE)
                 
-                if test_width < scroll_width - 40:
-                    current_line = test_line
-                else:
-                    lines.append(current_line)
-                    current_line = word + " "
-            
-            lines.append(current_line)
+                # Draw HUD background
+                pygame.draw.rect(screen, BLACK, (0, 0, 200, 190))
+                
+                screen.blit(score_text, (10, 10))
+                screen.blit(level_text, (10, 40))
+                screen.blit(treasures_text, (10, 70))
+                screen.blit(lives_text, (10, 100))
+                screen.blit(keys_text, (10, 130))
+                screen.blit(location_text, (10, 160))
             
-            y_offset = HEIGHT//3
-            for line in lines:
-                text = font_small.render(line, True, BLACK)
-                screen.blit(text, (WIDTH//2 - text.get_width()//2, y_offset))
-                y_offset += 30
+        elif self.state == CHALLENGE:
+            # Frozen map and the scroll with this riddle, then the answer and timer
+            modal_layer.draw((CHALLENGE, self.current_challenge, camera_x, camera_y), 180,
+                             self.map, camera_x, camera_y, self.draw_challenge_scroll)
             
-            # Draw answer box
-            pygame.draw.rect(screen, WHITE, (WIDTH//3, HEIGHT*2//3 - 40, WIDTH//3, 40))
-            pygame.draw.rect(screen, BROWN, (WIDTH//3, HEIGHT*2//3 - 40, WIDTH//3, 40), 2)
-            answer_text = font_small.render(self.explorer_answer, True, BLACK)
+            answer_text = render_text(font_small, self.explorer_answer, BLACK)
             screen.blit(answer_text, (WIDTH//2 - answer_text.get_width()//2, HEIGHT*2//3 - 30))
             
             # Draw timer
-            timer_width = (self.challenge_timer / self.challenge_time_limit) * scroll_width
-            pygame.draw.rect(screen, (198, 169, 91), (scroll_x, scroll_y + scroll_height - 30, timer_width, 10))
-            
-            # Draw instructions
-            instructions = font_small.render("Write your answer and press ENTER", True, BLACK)
-            screen.blit(instructions, (WIDTH//2 - instructions.get_width()//2, HEIGHT*5//6))
+            timer_width = (self.challenge_timer / self.challenge_time_limit) * SCROLL_RECT.width
+            pygame.draw.rect(screen, (198, 169, 91), (SCROLL_RECT.x, SCROLL_RECT.bottom - 30, timer_width, 10))
             
         elif self.state == GAME_OVER:
-            # Draw a dark overlay on the map
-            self.map.draw(self.camera_x, self.camera_y)
-            
-            # Semi-transparent overlay
-            overlay = pygame.Surface((WIDTH, HEIGHT), pygame.SRCALPHA)
-            overlay.fill((0, 0, 0, 200))  # Black with alpha
-            screen.blit(overlay, (0, 0))
+            # Nothing on the game over screen moves, so it is drawn once
+            modal_layer.draw((GAME_OVER, self.adventure_points, self.explorer.treasures, self.rank, self.seed,
+                              camera_x, camera_y), 200,
+                             self.map, camera_x, camera_y, self.draw_game_over)
             
-            # Draw game over screen
-            game_over_text = font_large.render("Adventure Complete!", True, GOLD)
-            screen.blit(game_over_text, (WIDTH//2 - game_over_text.get_width()//2, HEIGHT//4))
-            
-            score_text = font_medium.render(f"Final Adventure Points: {self.adventure_points}", True, WHITE)
-            treasures_text = font_medium.render(f"Treasures Discovered: {self.explorer.treasures}", True, WHITE)
-            level_text = font_medium.render(f"Explorer Rank: {self.rank}", True, WHITE)
-            
-            screen.blit(score_text, (WIDTH//2 - score_text.get_width()//2, HEIGHT//2 - 40))
-            screen.blit(treasures_text, (WIDTH//2 - treasures_text.get_width()//2, HEIGHT//2 + 10))
-            screen.blit(level_text, (WIDTH//2 - level_text.get_width()//2, HEIGHT//2 + 60))
+    def draw_challenge_scroll(self):
+        # Draw challenge background - antique scroll
+        scroll_x, scroll_y, scroll_width, scroll_height = SCROLL_RECT
+        
+        # Scroll background
+        pygame.draw.rect(screen, (244, 227, 188), SCROLL_RECT)
+        
+        # Scroll edges
+        pygame.draw.rect(screen, (198, 169, 91), SCROLL_RECT, 5)
+        
+        # Scroll decorative elements
+        pygame.draw.circle(screen, (198, 169, 91), (scroll_x + scroll_width//2, scroll_y + 20), 10)
+        pygame.draw.circle(screen, (198, 169, 91), (scroll_x + scroll_width//2, scroll_y + scroll_height - 20), 10)
+        
+        # Draw challenge text
+        challenge_text = render_text(font_medium, "Ancient Riddle!", BROWN)
+        screen.blit(challenge_text, (WIDTH//2 - challenge_text.get_width()//2, HEIGHT//4))
+        
+        # Challenge text was wrapped to fit the box when it was generated
+        y_offset = HEIGHT//3
+        for line in self.challenge_lines:
+            text = render_text(font_small, line, BLACK)
+            screen.blit(text, (WIDTH//2 - text.get_width()//2, y_offset))
+            y_offset += 30
+        
+        # Draw answer box
+        pygame.draw.rect(screen, WHITE, (WIDTH//3, HEIGHT*2//3 - 40, WIDTH//3, 40))
+        pygame.draw.rect(screen, BROWN, (WIDTH//3, HEIGHT*2//3 - 40, WIDTH//3, 40), 2)
+        
+        # Draw instructions
+        instructions = render_text(font_small, "Write your answer and press ENTER", BLACK)
+        screen.blit(instructions, (WIDTH//2 - instructions.get_width()//2, HEIGHT*5//6))
+        
+    def draw_game_over(self):
+        # Draw game over screen
+        game_over_text = render_text(font_large, "Adventure Complete!", GOLD)
+        screen.blit(game_over_text, (WIDTH//2 - game_over_text.get_width()//2, HEIGHT//4))
+        
+        score_text = render_text(font_medium, f"Final Adventure Points: {self.adventure_points}", WHITE)
+        treasures_text = render_text(font_medium, f"Treasures Discovered: {self.explorer.treasures}", WHITE)
+        level_text = render_text(font_medium, f"Explorer Rank: {self.rank}", WHITE)
+        
+        screen.blit(score_text, (WIDTH//2 - score_text.get_width()//2, HEIGHT//2 - 40))
+        screen.blit(treasures_text, (WIDTH//2 - treasures_text.get_width()//2, HEIGHT//2 + 10))
+        screen.blit(level_text, (WIDTH//2 - level_text.get_width()//2, HEIGHT//2 + 60))
+        
+        restart_text = render_text(font_medium, "Press SPACE to start a new adventure", WHITE)
+        screen.blit(restart_text, (WIDTH//2 - restart_text.get_width()//2, HEIGHT*3//4))
+        
+        replay_text = render_text(font_small, f"Press R to explore island #{self.seed} again", WHITE)
+        screen.blit(replay_text, (WIDTH//2 - replay_text.get_width()//2, HEIGHT*3//4 + 50))
+
+# Screen areas that change between PLAYING frames even when the camera stands still
+HUD_RECT = pygame.Rect(0, 0, 200, 190)
+MINIMAP_RECT = pygame.Rect(WIDTH - 150 - 10, 10, 150, 150).inflate(8, 8)
+
+class DirtyRectRenderer:
+    # Only redraws when the frame signature changes and only pushes the changed
+    # parts of the screen to the display. Static screens cost nothing per frame
+    def __init__(self):
+        self.last_signature = None
+        self.last_sprite_rects = []
+        self.last_overlay_rect = None
+        
+    def render(self, game):
+        signature = game.frame_signature()
+        if signature == self.last_signature and not profiler.show_overlay and self.last_overlay_rect is None:
+            return
             
-            restart_text = font_medium.render("Press SPACE to start a new adventure", True, WHITE)
-            screen.blit(restart_text, (WIDTH//2 - restart_text.get_width()//2, HEIGHT*3//4))
+        previous = self.last_signature
+        self.last_signature = signature
+        game.draw_frame()
+        
+        # Where the overlay is now and where it was, so hiding it clears it off the display
+        overlay_rect = profiler.draw_overlay()
+        overlay_rects = [rect for rect in (overlay_rect, self.last_overlay_rect) if rect]
+        self.last_overlay_rect = overlay_rect
+        if overlay_rects and previous == signature:
+            pygame.display.update(overlay_rects)
+            return
+        
+        # New screen, or the camera scrolled: everything changed
+        if previous is None or previous[0] != signature[0] or signature[0] in (MENU, GAME_OVER):
+            pygame.display.flip()
+        elif signature[0] == CHALLENGE:
+            pygame.display.update([SCROLL_RECT] + overlay_rects)
+        elif previous[1] != signature[1]:
+            pygame.display.flip()
+        else:
+            # Old and new sprite positions, plus the HUD and minimap
+            sprite_rects = game.sprite_rects()
+            rects = self.last_sprite_rects + sprite_rects + [HUD_RECT, MINIMAP_RECT] + overlay_rects
+            pygame.display.update(rects)
+            self.last_sprite_rects = sprite_rects
+            return
             
-        # Update the display
-        pygame.display.flip()
+        if signature[0] == PLAYING:
+            self.last_sprite_rects = game.sprite_rects()
 
 # Main game loop
-def main():
-    game = Game()
+def main(seed=None, dirty_rects=False, profile=False, trace_path=None, frames=None, fps=60, fog_of_war=False,
+         headless=False, infinite=False, record_path=None, replay_path=None, fast=False, start_frame=0):
+    init(headless)
+    map_size = (WIDTH, HEIGHT)
+    
+    # Recorded games seed everything random, so their replays play out the same
+    replay = InputReplay(replay_path) if replay_path else None
+    random_seed = None
+    if replay:
+        seed, map_size, fog_of_war, infinite = replay.seed, replay.map_size, replay.fog_of_war, replay.infinite
+        random_seed = replay.random_seed
+    elif record_path:
+        seed = random.randrange(2**32) if seed is None else seed
+        random_seed = random.randrange(2**64)
+    challenge_rng = None
+    if random_seed is not None:
+        random.seed(random_seed)
+        challenge_rng = random.Random(random.getrandbits(64))
+        
+    if replay:
+        game = Game(seed, map_size, replay, fog_of_war, infinite, challenge_rng)
+        game.state = replay.state
+    elif HEADLESS:
+        # Nobody is at the keyboard, so skip the menu and walk around at random
+        game = Game(seed, map_size, ScriptedInput(seed or 0), fog_of_war, infinite, challenge_rng)
+        game.state = PLAYING
+    else:
+        game = Game(seed, map_size, None, fog_of_war, infinite, challenge_rng)
+    recorder = None
+    if record_path:
+        recorder = game.controls = InputRecorder(record_path, game, random_seed)
     clock = pygame.time.Clock()
+    renderer = DirtyRectRenderer() if dirty_rects else None
+    profiler.enabled = profile or trace_path is not None
+    profiler.tracing = trace_path is not None
     
-    while True:
-        game.handle_events()
-        game.update()
-        game.draw()
-        clock.tick(60)  # 60 FPS
+    # The simulation advances in fixed ticks however long rendering takes, leftover
+    # time carries over and blends the rendered frame between the last two ticks
+    # A replay runs the ticks each frame ran when it was recorded instead. It
+    # keeps to real time from its first drawn frame unless it is fast
+    accumulator = 0.0
+    last_time = time.perf_counter()
+    replayed_ticks = 0
+    
+    try:
+        frame = 0
+        while frames is None or frame < frames:
+            if replay:
+                ticks = replay.next_frame()
+                if ticks is None:
+                    print(f"Replayed {frame} frames")
+                    break
+            drawing = not fast and frame >= start_frame
+            
+            profiler.begin_frame()
+            if HEADLESS and not replay:
+                # No real time to keep up with, one tick per frame as fast as possible
+                accumulator += TICK
+            elif not replay:
+                now = time.perf_counter()
+                accumulator += min(now - last_time, MAX_FRAME_TIME)
+                last_time = now
+                
+            with profiler.section("events"):
+                game.handle_events()
+            with profiler.section("update"):
+                if not replay:
+                    ticks = int(accumulator // TICK)
+                    accumulator -= ticks * TICK
+                for _ in range(ticks):
+                    game.update()
+            game.alpha = 1.0 if replay else accumulator / TICK
+            if not game.challenge_rng:
+                # Wrap the text of a few upcoming challenges while there is time
+                get_challenge_pool().prepare()
+            if recorder:
+                recorder.end_frame(ticks)
+            if drawing:
+                with profiler.section("draw"):
+                    if renderer:
+                        renderer.render(game)
+                    else:
+                        game.draw()
+            profiler.end_frame()
+            if frame == 0 and drawing and profiler.enabled:
+                # Cold start: init, map generation and the first frame, which is the
+                # menu unless the run went straight into play (headless, replays)
+                first_screen = "menu" if game.state == MENU else "game"
+                print(f"First {first_screen} frame drawn {(time.perf_counter() - IMPORT_TIME) * 1000:.0f} ms after import")
+            frame += 1
+            
+            if HEADLESS or not drawing:
+                continue
+            if replay:
+                if replayed_ticks == 0:
+                    last_time = time.perf_counter()
+                replayed_ticks += ticks
+                delay = last_time + replayed_ticks * TICK - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            else:
+                clock.tick(fps)  # Caps rendering only, the simulation stays at TICK_RATE
+    finally:
+        if recorder:
+            recorder.close()
+        if trace_path:
+            profiler.save_trace(trace_path)
+
+def map_seed(text):
+    # Seeds given on the command line, the same range new maps pick theirs from
+    seed = int(text)
+    if not 0 <= seed < 2**32:
+        raise argparse.ArgumentTypeError(f"seed must be from 0 to {2**32 - 1}, not {seed}")
+    return seed
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Treasure Hunter Adventure")
+    parser.add_argument("--seed", type=map_seed, help="explore the islands generated from this seed")
+    parser.add_argument("--dirty-rects", action="store_true",
+                        help="only redraw what changed, for slow machines")
+    parser.add_argument("--profile", action="store_true",
+                        help="time every frame, F3 shows the timings")
+    parser.add_argument("--trace", metavar="PATH",
+                        help="write per frame timings to a .csv or .json file on exit")
+    parser.add_argument("--headless", action="store_true",
+                        help="run without a window, driven by seeded random input")
+    parser.add_argument("--frames", type=int, help="quit after this many frames")
+    parser.add_argument("--fps", type=int, default=60,
+                        help="render at most this many frames per second, the game itself always runs at 60 ticks")
+    parser.add_argument("--fog", action="store_true", help="only show explored parts of the minimap")
+    parser.add_argument("--infinite", action="store_true",
+                        help="explore an endless world generated around the explorer as it goes")
+    parser.add_argument("--record", metavar="PATH", help="write every key press to a replay log")
+    parser.add_argument("--replay", metavar="PATH",
+                        help="play a replay log back, the seed and world options come from the log")
+    parser.add_argument("--fast", action="store_true",
+                        help="with --replay, run the whole log as fast as possible without drawing")
+    parser.add_argument("--start-frame", type=int, default=0, metavar="FRAME",
+                        help="with --replay, fast forward to this frame before drawing, e.g. to profile a stutter")
+    return parser.parse_args()
 
 if __name__ == "__main__":
-    main()
+    args = parse_args()
+    main(args.seed, args.dirty_rects, args.profile, args.trace, args.frames, args.fps, args.fog, args.headless,
+         args.infinite, args.record, args.replay, args.fast, args.start_frame)